@@ -0,0 +1,358 @@
+#! /usr/bin/env python
+"""Measure the per test item overhead of pytest-twisted.
+
+Each case generates a test module with a small and a large number of tests,
+runs pytest on both in a subprocess and reports the time per additional item.
+Startup and collection costs cancel out that way.  Results are written as JSON
+so they can be compared across releases.
+
+    python benchmarks/per_item_overhead.py --output results.json
+    python benchmarks/per_item_overhead.py --reactor asyncio --case sync
+    python benchmarks/per_item_overhead.py --mode greenlet --mode thread
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+
+
+HEADER = """
+import pytest
+import pytest_twisted
+from twisted.internet import defer
+"""
+
+CASES = {
+    "baseline": {
+        "description": "plain tests with the plugin disabled",
+        "plugin": False,
+        "header": "",
+        "test": """
+        def test_{index}():
+            pass
+        """,
+    },
+    "sync": {
+        "description": "plain synchronous tests",
+        "test": """
+        def test_{index}():
+            pass
+        """,
+    },
+    "inline_callbacks": {
+        "description": "pytest_twisted.inlineCallbacks tests",
+        "test": """
+        @pytest_twisted.inlineCallbacks
+        def test_{index}():
+            yield defer.succeed(None)
+        """,
+    },
+    "inline_callbacks_collection": {
+        "description": "collecting pytest_twisted.inlineCallbacks tests",
+        "arguments": ["--collect-only"],
+        "test": """
+        @pytest_twisted.inlineCallbacks
+        def test_{index}(request):
+            yield defer.succeed(None)
+        """,
+    },
+    "ensure_deferred": {
+        "description": "pytest_twisted.ensureDeferred tests",
+        "python": (3, 5),
+        "test": """
+        @pytest_twisted.ensureDeferred
+        async def test_{index}():
+            await defer.succeed(None)
+        """,
+    },
+    "async_fixture": {
+        "description": "tests using a function scoped async fixture",
+        "python": (3, 5),
+        "fixtures": """
+        @pytest_twisted.async_fixture()
+        async def foo():
+            return await defer.succeed(42)
+        """,
+        "test": """
+        def test_{index}(foo):
+            pass
+        """,
+    },
+    "async_yield_fixture": {
+        "description": "tests using a function scoped async yield fixture",
+        "python": (3, 6),
+        "fixtures": """
+        @pytest_twisted.async_yield_fixture()
+        async def foo():
+            yield await defer.succeed(42)
+        """,
+        "test": """
+        def test_{index}(foo):
+            pass
+        """,
+    },
+    "hypothesis": {
+        "description": "hypothesis tests with ten examples each",
+        "python": (3, 5),
+        "requires": "hypothesis",
+        "fixtures": """
+        import hypothesis
+        import hypothesis.strategies
+        """,
+        "test": """
+        @hypothesis.settings(max_examples=10, database=None)
+        @hypothesis.given(x=hypothesis.strategies.integers())
+        @pytest_twisted.ensureDeferred
+        async def test_{index}(x):
+            await defer.succeed(x)
+        """,
+    },
+}
+
+MODES = ("greenlet", "thread")
+
+REACTOR_REQUIREMENTS = {
+    "qt5reactor": "qt5reactor",
+}
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--reactor",
+        action="append",
+        help="reactor to measure, may be repeated (default: all)",
+    )
+    parser.add_argument(
+        "--mode",
+        action="append",
+        choices=MODES,
+        help="--twisted-mode to measure, may be repeated (default: all)",
+    )
+    parser.add_argument(
+        "--case",
+        action="append",
+        choices=sorted(CASES),
+        help="case to measure, may be repeated (default: all)",
+    )
+    parser.add_argument("--small", type=int, default=50)
+    parser.add_argument("--large", type=int, default=1000)
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs per measurement, the fastest one is used",
+    )
+    parser.add_argument("--output", help="write the JSON results here")
+    parser.add_argument(
+        "pytest_args",
+        nargs="*",
+        help="extra pytest arguments, pass them after --",
+    )
+
+    return parser.parse_args(arguments)
+
+
+def missing_requirement(module):
+    if module is None:
+        return None
+
+    code = "import {}".format(module)
+    with open(os.devnull, "w") as devnull:
+        returncode = subprocess.call(
+            [sys.executable, "-c", code],
+            stdout=devnull,
+            stderr=devnull,
+        )
+
+    if returncode != 0:
+        return "{} is not installed".format(module)
+
+    return None
+
+
+def write_module(directory, case, count):
+    header = textwrap.dedent(case.get("header", HEADER))
+    fixtures = textwrap.dedent(case.get("fixtures", ""))
+    test = textwrap.dedent(case["test"])
+    path = os.path.join(directory, "test_generated.py")
+    with open(path, "w") as f:
+        f.write(header)
+        f.write(fixtures)
+        for index in range(count):
+            f.write(test.format(index=index))
+
+    return path
+
+
+def run_pytest(directory, arguments):
+    command = [
+        sys.executable,
+        "-m",
+        "pytest",
+        "-q",
+        "-p",
+        "no:cacheprovider",
+    ] + list(arguments)
+
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        returncode = subprocess.call(
+            command,
+            cwd=directory,
+            stdout=devnull,
+            stderr=devnull,
+        )
+        elapsed = time.time() - start
+
+    return returncode, elapsed
+
+
+def measure(case, reactor, mode, options):
+    """Return the fastest run time for the small and the large module."""
+    if case.get("plugin", True):
+        arguments = [
+            "--reactor={}".format(reactor),
+            "--twisted-mode={}".format(mode),
+        ]
+        arguments.extend(options.pytest_args)
+    else:
+        arguments = ["-p", "no:twisted"]
+    arguments.extend(case.get("arguments", []))
+
+    timings = {}
+    directory = tempfile.mkdtemp(prefix="pytest-twisted-benchmark-")
+    try:
+        for count in (options.small, options.large):
+            write_module(directory=directory, case=case, count=count)
+            best = None
+            for _ in range(options.repeat):
+                returncode, elapsed = run_pytest(directory, arguments)
+                if returncode != 0:
+                    raise RuntimeError(
+                        "pytest exited with {} for {} items".format(
+                            returncode,
+                            count,
+                        ),
+                    )
+                best = elapsed if best is None else min(best, elapsed)
+            timings[count] = best
+    finally:
+        shutil.rmtree(directory)
+
+    return timings
+
+
+def installed_version(distribution):
+    try:
+        from importlib.metadata import version
+    except ImportError:
+        from pkg_resources import get_distribution
+
+        return get_distribution(distribution).version
+
+    return version(distribution)
+
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+
+    import pytest
+    import twisted
+
+    import pytest_twisted
+
+    reactors = options.reactor or sorted(pytest_twisted.reactor_installers)
+    case_names = options.case or sorted(CASES)
+    modes = options.mode or MODES
+
+    results = []
+    for reactor, mode in itertools.product(reactors, modes):
+        reactor_missing = missing_requirement(
+            REACTOR_REQUIREMENTS.get(reactor),
+        )
+        if mode == "thread" and reactor == "qt5reactor":
+            reactor_missing = "Qt must run on the main thread"
+
+        for name in case_names:
+            case = CASES[name]
+            if not case.get("plugin", True) and mode != modes[0]:
+                # the mode makes no difference without the plugin
+                continue
+
+            result = {
+                "reactor": reactor,
+                "mode": mode,
+                "case": name,
+                "description": case["description"],
+                "small": options.small,
+                "large": options.large,
+            }
+            results.append(result)
+
+            skip = reactor_missing or missing_requirement(case.get("requires"))
+            if sys.version_info < case.get("python", (0,)):
+                skip = "requires Python {}".format(
+                    ".".join(str(part) for part in case["python"]),
+                )
+            if skip is not None:
+                result["skipped"] = skip
+                continue
+
+            try:
+                timings = measure(
+                    case=case,
+                    reactor=reactor,
+                    mode=mode,
+                    options=options,
+                )
+            except RuntimeError as e:
+                result["error"] = str(e)
+                continue
+
+            items = options.large - options.small
+            elapsed = timings[options.large] - timings[options.small]
+            per_item = elapsed / items
+            result["seconds"] = {
+                str(count): elapsed
+                for count, elapsed in timings.items()
+            }
+            result["seconds_per_item"] = per_item
+            sys.stderr.write(
+                "{reactor:>12} {mode:<8} {case:<28} {per_item:9.1f} us/item\n"
+                .format(
+                    reactor=reactor,
+                    mode=mode,
+                    case=name,
+                    per_item=per_item * 1e6,
+                ),
+            )
+
+    report = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "pytest": pytest.__version__,
+        "twisted": twisted.__version__,
+        "pytest_twisted": installed_version("pytest-twisted"),
+        "pytest_args": options.pytest_args,
+        "results": results,
+    }
+
+    serialized = json.dumps(report, indent=2, sort_keys=True)
+    if options.output is None:
+        print(serialized)
+    else:
+        with open(options.output, "w") as f:
+            f.write(serialized + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+"""Measure the latency of waiting on the reactor thread from another thread.
+
+The reactor runs in a thread as with --twisted-mode=thread.  The main thread
+then waits for already fired Deferreds, one at a time through Twisted's
+blockingCallFromThread() and pytest-twisted's thread bridge, and in batches
+through the bridge.  Results are written as JSON.
+
+    python benchmarks/thread_bridge_latency.py --calls 20000
+"""
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=10000)
+    parser.add_argument("--batch", type=int, default=10)
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs per measurement, the fastest one is used",
+    )
+    parser.add_argument("--output", help="write the JSON results here")
+
+    return parser.parse_args(arguments)
+
+
+def best_of(repeat, f):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def main(arguments=None):
+    options = parse_arguments(arguments)
+
+    import twisted
+    from twisted.internet import defer, reactor
+    from twisted.internet.threads import blockingCallFromThread
+
+    import pytest_twisted
+
+    running = threading.Event()
+    reactor.callWhenRunning(running.set)
+    thread = threading.Thread(
+        target=reactor.run,
+        kwargs={"installSignalHandlers": False},
+    )
+    thread.daemon = True
+    thread.start()
+    running.wait()
+
+    bridge = pytest_twisted._ThreadBridge(reactor)
+    calls = options.calls
+    batches = calls // options.batch
+
+    def blocking_call_from_thread():
+        for _ in range(calls):
+            blockingCallFromThread(reactor, defer.succeed, None)
+
+    def bridge_call():
+        for _ in range(calls):
+            bridge.call(defer.succeed, None)
+
+    def bridge_call_many():
+        batch = [(defer.succeed, (None,))] * options.batch
+        for _ in range(batches):
+            bridge.call_many(batch)
+
+    cases = [
+        ("blockingCallFromThread", calls, blocking_call_from_thread),
+        ("bridge", calls, bridge_call),
+        ("bridge_batched", batches * options.batch, bridge_call_many),
+    ]
+
+    results = []
+    try:
+        for name, count, f in cases:
+            elapsed = best_of(options.repeat, f)
+            results.append({
+                "case": name,
+                "calls": count,
+                "seconds": elapsed,
+                "seconds_per_call": elapsed / count,
+            })
+            sys.stderr.write(
+                "{name:<24} {per_call:9.1f} us/call\n".format(
+                    name=name,
+                    per_call=elapsed / count * 1e6,
+                ),
+            )
+    finally:
+        reactor.callFromThread(reactor.stop)
+        thread.join()
+
+    report = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "twisted": twisted.__version__,
+        "reactor": type(reactor).__name__,
+        "batch": options.batch,
+        "results": results,
+    }
+
+    serialized = json.dumps(report, indent=2, sort_keys=True)
+    if options.output is None:
+        print(serialized)
+    else:
+        with open(options.output, "w") as f:
+            f.write(serialized + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
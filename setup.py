@@ -15,7 +15,11 @@ setuptools.setup(
     packages=setuptools.find_packages('src'),
     package_dir={'': 'src'},
     python_requires='>=2.7,!=3.0.*,!=3.1.*,!=3.2.*,!=3.3.*,!=3.4.*,!=3.5.*',
-    install_requires=["greenlet", "pytest>=2.3", "decorator"],
+    install_requires=[
+        "greenlet",
+        "pytest>=2.3",
+        "decorator; python_version < '3'",
+    ],
     extras_require={
         "dev": ["pre-commit", "black"],
         "pyside2": [
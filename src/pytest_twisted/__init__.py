@@ -1,26 +1,52 @@
+import collections
 import functools
+import importlib
 import inspect
 import itertools
+import json
+import os
+import random
+import re
 import signal
 import sys
 import threading
+import time
+import timeit
 import warnings
+import weakref
 
-import decorator
-import greenlet
 import pytest
 
-from twisted.internet import defer, error
-from twisted.internet.threads import blockingCallFromThread
-from twisted.python import failure
 
-if sys.version_info[0] == 3:
-    from pytest_twisted.three import (
-        _async_pytest_fixture_setup,
-        _async_pytest_pyfunc_call,
-    )
-elif sys.version_info[0] == 2:
-    from pytest_twisted.two import _async_pytest_pyfunc_call
+class _LazyModule(object):
+    """Stand-in for a module which is only imported once it is used.
+
+    The first attribute access imports the module and rebinds the global name
+    to it so later lookups cost nothing extra.  This keeps loading the plugin
+    cheap for pytest runs which never need Twisted.
+    """
+
+    def __init__(self, global_name, module_name):
+        self._global_name = global_name
+        self._module_name = module_name
+
+    def __getattr__(self, name):
+        module = importlib.import_module(self._module_name)
+        globals()[self._global_name] = module
+
+        return getattr(module, name)
+
+
+decorator = _LazyModule("decorator", "decorator")
+greenlet = _LazyModule("greenlet", "greenlet")
+defer = _LazyModule("defer", "twisted.internet.defer")
+error = _LazyModule("error", "twisted.internet.error")
+failure = _LazyModule("failure", "twisted.python.failure")
+log = _LazyModule("log", "twisted.python.log")
+logger = _LazyModule("logger", "twisted.logger")
+
+# async fixtures are only supported on Python 3
+_implementation = _LazyModule("_implementation", "pytest_twisted.three")
 
 
 class WrongReactorAlreadyInstalledError(Exception):
@@ -51,13 +77,139 @@ class AsyncFixtureUnsupportedScopeError(Exception):
         )
 
 
+class DeferredTimeoutError(Exception):
+    @classmethod
+    def from_seconds(cls, seconds):
+        return cls(
+            'test did not complete within {} seconds'.format(seconds),
+        )
+
+
+class ReactorDeadlockError(Exception):
+    @classmethod
+    def from_deferred(cls, deferred):
+        return cls(
+            'reactor is idle so {!r} can never fire'.format(deferred),
+        )
+
+
+class ReactorBlockedError(Exception):
+    @classmethod
+    def from_callback(cls, description, seconds, limit):
+        return cls(
+            'reactor blocked for {:.0f} ms by {} exceeding {} ms'.format(
+                seconds * 1000,
+                description,
+                limit,
+            ),
+        )
+
+
+class DirtyReactorError(Exception):
+    @classmethod
+    def from_leaks(cls, leaks):
+        return cls('test left the reactor dirty: {}'.format('; '.join(leaks)))
+
+
 class _config:
     external_reactor = False
+    timeout = None
+    deadlock_timeout = None
+    slow_callback = None
+    monitor_callbacks = False
+    max_blocking = {}
+    lazy_reactor = None
+    mode = "greenlet"
+    concurrent_fixture_setup = False
+    sync_fast_path = False
+    log_events = 0
+    failures = "full"
+    dirty_reactor = None
 
 
 class _instances:
     gr_twisted = None
     reactor = None
+    reactor_thread = None
+    thread_bridge = None
+    virtual_clock = None
+    callback_monitor = None
+    log_events = None
+    clean_failure = None
+    uncleaned_failures = None
+    reactor_check = None
+    reactor_import_hook = None
+    greenlet_fixturedef = None
+
+
+class _concurrency:
+    limit = 1
+    items = []
+    index = {}
+    pending = {}
+    hypothesis_limit = 1
+    filling_fixtures = False
+    pending_fixtures = set()
+
+
+class _observers:
+    phases = []
+    switches = []
+    previous_trace = None
+    durations = None
+    profiler = None
+    trace = None
+    memory = None
+
+
+def _add_phase_observer(observer):
+    """Register observer for phase_started() and phase_finished() calls."""
+    _observers.phases.append(observer)
+
+
+def _start_phase(nodeid, name):
+    """Tell the phase observers a phase started, returns the phase or None."""
+    if not _observers.phases:
+        return None
+
+    phase = (nodeid, name)
+    for observer in _observers.phases:
+        observer.phase_started(phase)
+
+    return phase
+
+
+def _finish_phase(phase):
+    """Tell the phase observers the phase returned by _start_phase() ended."""
+    if phase is None:
+        return
+
+    for observer in reversed(_observers.phases):
+        observer.phase_finished(phase)
+
+
+def _trace_deferred(nodeid, name, d):
+    """Record a span from now until d fires if a trace is being written."""
+    if _observers.trace is not None:
+        _observers.trace.deferred_span(nodeid=nodeid, name=name, d=d)
+
+
+def _add_switch_listener(listener):
+    """Call listener(origin, target) on every greenlet switch."""
+    if not _observers.switches:
+        _observers.previous_trace = greenlet.settrace(_trace_switch)
+
+    _observers.switches.append(listener)
+
+
+def _trace_switch(event, args):
+    if event in ("switch", "throw"):
+        origin, target = args
+        for listener in _observers.switches:
+            listener(origin, target)
+
+    if _observers.previous_trace is not None:
+        _observers.previous_trace(event, args)
 
 
 def _deprecate(deprecated, recommended):
@@ -80,6 +232,7 @@ def _deprecate(deprecated, recommended):
 
 
 def blockon(d):
+    _ensure_reactor()
     if _config.external_reactor:
         return block_from_thread(d)
 
@@ -92,25 +245,261 @@ def blockon_default(d):
         current is not _instances.gr_twisted
     ), "blockon cannot be called from the twisted greenlet"
     result = []
+    deadlocked = []
 
     def cb(r):
+        if result:
+            # already failed as deadlocked
+            return None
+
+        if deadlocked:
+            e = ReactorDeadlockError.from_deferred(d)
+            if isinstance(r, failure.Failure):
+                e.__cause__ = r.value
+            r = failure.Failure(e)
+
         result.append(r)
         if greenlet.getcurrent() is not current:
             current.switch(result)
 
+    def deadlock():
+        deadlocked.append(True)
+        d.cancel()
+        if not result:
+            # the cancellation was ignored
+            cb(None)
+
     d.addCallbacks(cb, cb)
     if not result:
+        watchdog = None
+        if _config.deadlock_timeout:
+            watchdog = _watch_for_deadlock(deadlock)
+
         _result = _instances.gr_twisted.switch()
         assert _result is result, "illegal switch in blockon"
 
+        if watchdog is not None and watchdog[0].active():
+            watchdog[0].cancel()
+
     if isinstance(result[0], failure.Failure):
         result[0].raiseException()
 
     return result[0]
 
 
+def blockon_many(iterable, concurrency=None):
+    """Wait for the Deferreds produced by iterable and return their results.
+
+    At most concurrency items are pulled from iterable and waited on at the
+    same time, the next one is only pulled once a slot is free.  Results are
+    returned in order, the first failure is raised once the running items
+    have finished.
+    """
+    if concurrency is not None and concurrency < 1:
+        raise ValueError(
+            "concurrency must be at least 1, got {!r}".format(concurrency),
+        )
+
+    _ensure_reactor()
+    if _config.external_reactor:
+        return _thread_bridge().call(_gather, iterable, concurrency)
+
+    return blockon_default(_gather(iterable, concurrency))
+
+
+def _gather(iterable, concurrency):
+    return _Gather(iterable, concurrency).deferred
+
+
+class _Gather(object):
+    """Pull Deferreds from an iterable while fewer than limit are running."""
+
+    def __init__(self, iterable, limit):
+        self.items = enumerate(iterable)
+        self.limit = limit
+        self.results = []
+        self.running = {}
+        self.failure = None
+        self.exhausted = False
+        self.pulling = False
+        self.deferred = defer.Deferred(self._cancel)
+        self._pull()
+
+    def _pull(self):
+        # completions during the loop only free their slot, the loop itself
+        # pulls the next items so already fired Deferreds do not recurse
+        self.pulling = True
+        try:
+            while not self.exhausted and self.failure is None and (
+                self.limit is None or len(self.running) < self.limit
+            ):
+                try:
+                    index, item = next(self.items)
+                except StopIteration:
+                    self.exhausted = True
+                    break
+                except Exception:
+                    self.failure = failure.Failure()
+                    break
+
+                if not isinstance(item, defer.Deferred):
+                    item = defer.succeed(item)
+
+                self.results.append(None)
+                self.running[index] = item
+                item.addBoth(self._finished, index)
+        finally:
+            self.pulling = False
+
+        if not self.running and not self.deferred.called:
+            if self.failure is not None:
+                self.deferred.errback(self.failure)
+            elif self.exhausted:
+                self.deferred.callback(self.results)
+
+    def _finished(self, result, index):
+        del self.running[index]
+        if isinstance(result, failure.Failure):
+            if self.failure is None:
+                self.failure = result
+        else:
+            self.results[index] = result
+
+        if not self.pulling:
+            self._pull()
+
+        return None
+
+    def _cancel(self, d):
+        self.exhausted = True
+        for item in list(self.running.values()):
+            item.cancel()
+
+
+def _watch_for_deadlock(deadlock):
+    """Call deadlock once the reactor has been idle for the deadlock timeout.
+
+    The reactor is idle when the check itself is the only delayed call and
+    there is no I/O or thread work so nothing could fire the awaited Deferred.
+    The returned list holds the currently scheduled check.
+    """
+    reactor = _instances.reactor
+    deadlock_timeout = _config.deadlock_timeout
+    interval = min(0.1, deadlock_timeout)
+    idle_since = []
+    watchdog = []
+
+    def check():
+        others = [
+            call
+            for call in reactor.getDelayedCalls()
+            if call is not watchdog[0]
+        ]
+        if others or _reactor_has_pending_work(reactor):
+            del idle_since[:]
+        elif not idle_since:
+            idle_since.append(time.time())
+        elif time.time() - idle_since[0] >= deadlock_timeout:
+            deadlock()
+            return
+
+        watchdog[0] = reactor.callLater(interval, check)
+
+    watchdog.append(reactor.callLater(interval, check))
+
+    return watchdog
+
+
 def block_from_thread(d):
-    return blockingCallFromThread(_instances.reactor, lambda x: x, d)
+    return _thread_bridge().call(lambda x: x, d)
+
+
+class _ThreadBridge(object):
+    """Run calls in the reactor thread and wait for their results.
+
+    Unlike blockingCallFromThread() each waiting thread reuses one lock, and
+    calls submitted before the reactor gets to them share a single
+    callFromThread() wakeup.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self._local = threading.local()
+        self._submitted = []
+        self._submitted_lock = threading.Lock()
+
+    def _waiter(self):
+        waiter = getattr(self._local, "waiter", None)
+        if waiter is None:
+            # held while idle, released by the reactor thread when done
+            waiter = threading.Lock()
+            waiter.acquire()
+            self._local.waiter = waiter
+
+        return waiter
+
+    def call(self, f, *args):
+        """Call f in the reactor thread and wait for its Deferred."""
+        result, = self.call_many([(f, args)])
+
+        return result
+
+    def call_many(self, calls):
+        """Run each (f, args) pair in the reactor thread and wait for all.
+
+        The results are returned in order, the first failure is raised.
+        """
+        waiter = self._waiter()
+        results = [None] * len(calls)
+        remaining = [len(calls)]
+
+        def done(result, index):
+            results[index] = result
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                waiter.release()
+
+        if not calls:
+            return results
+
+        with self._submitted_lock:
+            wakeup = not self._submitted
+            self._submitted.extend(
+                (f, args, done, index)
+                for index, (f, args) in enumerate(calls)
+            )
+
+        if wakeup:
+            self.reactor.callFromThread(self._run_submitted)
+
+        try:
+            waiter.acquire()
+        except BaseException:
+            # the reactor thread will still release this lock later
+            self._local.waiter = None
+            raise
+
+        for result in results:
+            if isinstance(result, failure.Failure):
+                result.raiseException()
+
+        return results
+
+    def _run_submitted(self):
+        with self._submitted_lock:
+            submitted, self._submitted = self._submitted, []
+
+        for f, args, done, index in submitted:
+            defer.maybeDeferred(f, *args).addBoth(done, index)
+
+
+def _thread_bridge():
+    bridge = _instances.thread_bridge
+    if bridge is None or bridge.reactor is not _instances.reactor:
+        bridge = _ThreadBridge(_instances.reactor)
+        _instances.thread_bridge = bridge
+
+    return bridge
 
 
 def decorator_apply(dec, func):
@@ -118,11 +507,24 @@ def decorator_apply(dec, func):
     Decorate a function by preserving the signature even if dec
     is not a signature-preserving decorator.
 
+    On Python 3 the wrapper's __wrapped__ attribute is enough for
+    inspect.signature() and thus pytest to see the original signature.
+    Python 2 needs a generated function with the same signature.
+
     https://github.com/micheles/decorator/blob/55a68b5ef1951614c5c37a6d201b1f3b804dbce6/docs/documentation.md#dealing-with-third-party-decorators
     """
-    return decorator.FunctionMaker.create(
-        func, 'return decfunc(%(signature)s)',
-        dict(decfunc=dec(func)), __wrapped__=func)
+    decorated = dec(func)
+
+    if sys.version_info[0] == 2:
+        return decorator.FunctionMaker.create(
+            func, 'return decfunc(%(signature)s)',
+            dict(decfunc=decorated), __wrapped__=func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return decorated(*args, **kwargs)
+
+    return wrapper
 
 
 class DecoratorArgumentsError(Exception):
@@ -204,6 +606,25 @@ def ensureDeferred(f):
     return f
 
 
+def timeout(seconds):
+    """
+    Mark a test to have its Deferred cancelled after the given seconds.
+
+    The cancellation happens inside the reactor so it keeps running for the
+    following tests.  This overrides the ``twisted_timeout`` ini option.
+    """
+    return pytest.mark.twisted_timeout(seconds)
+
+
+def max_blocking(ms):
+    """
+    Mark a test to fail if a reactor callback blocks longer than ms.
+
+    Callbacks run while the test and its fixtures are set up count as well.
+    """
+    return pytest.mark.twisted_max_blocking(ms)
+
+
 def init_twisted_greenlet():
     if _instances.reactor is None or _instances.gr_twisted:
         return
@@ -224,10 +645,114 @@ def init_twisted_greenlet():
                 functools.partial(signal.default_int_handler),
             )
         _instances.gr_twisted = greenlet.greenlet(_instances.reactor.run)
-        # give me better tracebacks:
-        failure.Failure.cleanFailure = lambda self: None
+        _patch_clean_failure()
     else:
         _config.external_reactor = True
+        if _config.failures != "full":
+            warnings.warn(
+                (
+                    '--twisted-failures={} is ignored since the reactor was'
+                    ' started outside of pytest-twisted.'
+                ).format(_config.failures),
+                RuntimeWarning,
+            )
+
+
+def _patch_clean_failure():
+    """Keep or release the frames of failures as configured.
+
+    With "full" Deferreds no longer clean the failures they hold.  Recent
+    Twisted versions never clean the failures held by Deferreds themselves,
+    so "clean" does what older ones did: a failure is cleaned once it is
+    left over after a Deferred ran its callbacks.  Failures which are not
+    the result of a Deferred are not touched.  With "clean-after-report"
+    every failure created from then on is kept as is until the test which
+    created it has been reported and cleaned then.
+    """
+    if _instances.clean_failure is not None:
+        return
+
+    clean_failure = failure.Failure.cleanFailure
+    _instances.clean_failure = clean_failure
+    if _config.failures == "clean":
+        class CleaningDebugInfo(defer.DebugInfo):
+            """Clean the failure a Deferred keeps for unhandled errors."""
+
+            @property
+            def failResult(self):
+                return self.__dict__.get("failResult")
+
+            @failResult.setter
+            def failResult(self, result):
+                if result is not None:
+                    clean_failure(result)
+                self.__dict__["failResult"] = result
+
+        defer.DebugInfo = CleaningDebugInfo
+        return
+
+    # give me better tracebacks:
+    failure.Failure.cleanFailure = lambda self: None
+    if _config.failures != "clean-after-report":
+        return
+
+    uncleaned = weakref.WeakSet()
+    init = failure.Failure.__init__
+
+    @functools.wraps(init)
+    def tracked_init(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        uncleaned.add(self)
+
+    failure.Failure.__init__ = tracked_init
+    _instances.uncleaned_failures = uncleaned
+
+
+def _clean_reported_failures():
+    uncleaned = _instances.uncleaned_failures
+    if not uncleaned:
+        return
+
+    for f in list(uncleaned):
+        _instances.clean_failure(f)
+    uncleaned.clear()
+
+
+def init_twisted_thread():
+    """Run the reactor in a dedicated thread for --twisted-mode=thread."""
+    if _instances.reactor is None or _instances.reactor_thread is not None:
+        return
+
+    reactor = _instances.reactor
+    if not reactor.running:
+        running = threading.Event()
+        reactor.callWhenRunning(running.set)
+        thread = threading.Thread(
+            target=reactor.run,
+            kwargs={"installSignalHandlers": False},
+            name="twisted reactor",
+        )
+        thread.daemon = True
+        thread.start()
+        running.wait()
+        _instances.reactor_thread = thread
+
+    _config.external_reactor = True
+
+
+def stop_twisted_thread():
+    thread = _instances.reactor_thread
+    if thread is None:
+        return
+
+    def stop():
+        try:
+            _instances.reactor.stop()
+        except error.ReactorNotRunning:
+            pass
+
+    _instances.reactor.callFromThread(stop)
+    thread.join()
 
 
 def stop_twisted_greenlet():
@@ -260,11 +785,8 @@ def _marked_async_fixture(mark):
         except IndexError:
             scope = kwargs.get('scope', 'function')
 
-        if scope not in ['function', 'module']:
+        if scope not in ['function', 'class', 'module', 'package', 'session']:
             # TODO: handle...
-            #       - class
-            #       - package
-            #       - session
             #       - dynamic
             #
             #       https://docs.pytest.org/en/latest/reference.html#pytest-fixture-api
@@ -287,148 +809,1769 @@ async_fixture = _marked_async_fixture('async_fixture')
 async_yield_fixture = _marked_async_fixture('async_yield_fixture')
 
 
+class _PendingFixtureValue(object):
+    """Stand-in for the value of an async fixture still being set up."""
+
+    def __init__(self, deferred):
+        self._result = []
+        self._waiters = []
+        _concurrency.pending_fixtures.add(self)
+        deferred.addBoth(self._fire)
+
+    def _fire(self, result):
+        _concurrency.pending_fixtures.discard(self)
+        self._result.append(result)
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.called:
+                waiter.callback(result)
+
+    def wait(self):
+        """Get a new Deferred firing with the eventual fixture value."""
+        d = defer.Deferred()
+        if self._result:
+            d.callback(self._result[0])
+        else:
+            self._waiters.append(d)
+
+        return d
+
+
+def _concurrent_fixture_setup_enabled():
+    greenlet_mode = _instances.gr_twisted is not None
+    return greenlet_mode and _config.concurrent_fixture_setup
+
+
+def _fixture_phase_nodeid(request):
+    node = getattr(request, "node", None)
+    return getattr(node, "nodeid", "")
+
+
+def _wait_for_pending_fixtures():
+    """Wait for all async fixtures still being set up.
+
+    Regular fixtures must not see a stand-in, neither as an argument nor
+    when they call getfixturevalue() themselves.
+    """
+    for pending in list(_concurrency.pending_fixtures):
+        blockon_default(pending.wait())
+
+
+def _filling_fixture_closure(fixturedef, request):
+    """Check if pytest itself requests fixturedef while filling a test.
+
+    Only then may a stand-in be returned, any other getfixturevalue() call
+    gets the real value.
+    """
+    if not _concurrency.filling_fixtures:
+        return False
+
+    parent = getattr(request, "_parent_request", None)
+    parent_fixturedef = getattr(parent, "_fixturedef", None)
+    if parent_fixturedef is None:
+        return fixturedef.argname in getattr(parent, "fixturenames", ())
+
+    return fixturedef.argname in parent_fixturedef.argnames
+
+
 def pytest_fixture_setup(fixturedef, request):
     """Interface pytest to async for async and async yield fixtures."""
     # TODO: what about _adding_ inlineCallbacks fixture support?
+    # With a lazy reactor the session scoped twisted_greenlet is updated
+    # once the reactor is installed, which requesting it explicitly does.
+    own = getattr(fixturedef.func, "__module__", None) == __name__
+    if own and fixturedef.argname == "twisted_greenlet":
+        _instances.greenlet_fixturedef = fixturedef
+    elif "twisted_greenlet" in fixturedef.argnames:
+        _ensure_reactor()
+
+    concurrent = _concurrent_fixture_setup_enabled()
     maybe_mark = _get_mark(fixturedef.func)
     if maybe_mark is None:
+        if concurrent:
+            _wait_for_pending_fixtures()
         return None
 
     mark = maybe_mark
 
-    _run_inline_callbacks(
-        _async_pytest_fixture_setup,
-        fixturedef,
-        request,
-        mark,
+    if _ensure_reactor():
+        concurrent = _concurrent_fixture_setup_enabled()
+    concurrent = concurrent and _filling_fixture_closure(fixturedef, request)
+
+    phase = _start_phase(
+        nodeid=_fixture_phase_nodeid(request),
+        name="setup {}".format(fixturedef.argname),
     )
+    try:
+        if concurrent:
+            d = _start_inline_callbacks(
+                _implementation._async_pytest_fixture_setup,
+                fixturedef,
+                request,
+                mark,
+            )
+            _trace_deferred(
+                nodeid=_fixture_phase_nodeid(request),
+                name="run setup {}".format(fixturedef.argname),
+                d=d,
+            )
+            pending = _PendingFixtureValue(d)
+            cache_key = fixturedef.cache_key(request)
+            fixturedef.cached_result = (pending, cache_key, None)
+
+            return pending
+
+        _run_inline_callbacks(
+            _implementation._async_pytest_fixture_setup,
+            fixturedef,
+            request,
+            mark,
+        )
+    finally:
+        _finish_phase(phase)
 
     return not None
 
 
-def _create_async_yield_fixture_finalizer(coroutine):
+@pytest.hookimpl(trylast=True)
+def pytest_runtest_setup(item):
+    """Wait for the concurrently set up async fixtures of a test.
+
+    The reactor state is recorded afterwards for the dirty reactor check.
+    """
+    _concurrency.filling_fixtures = False
+    funcargs = getattr(item, "funcargs", None)
+    if funcargs and "twisted_greenlet" in item._fixtureinfo.argnames:
+        _ensure_reactor()
+        if funcargs["twisted_greenlet"] is None:
+            funcargs["twisted_greenlet"] = _instances.gr_twisted
+    if funcargs and _concurrent_fixture_setup_enabled():
+        for name, value in list(funcargs.items()):
+            if isinstance(value, _PendingFixtureValue):
+                funcargs[name] = blockon_default(value.wait())
+        _wait_for_pending_fixtures()
+
+    check = _instances.reactor_check
+    if check is not None:
+        check.start()
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_runtest_teardown(item, nextitem):
+    """Report or fail a test which left work behind in the reactor.
+
+    A test started early which was not called, for example because its
+    setup failed, is waited for so that its errors are not lost.
+    """
+    _concurrency.filling_fixtures = False
+    started = _concurrency.pending.pop(item, None)
+    if started is not None:
+        blockon_default(started)
+
+    check = _instances.reactor_check
+    if check is None:
+        return
+
+    leaks = check.finish()
+    if not leaks:
+        return
+
+    if _config.dirty_reactor == "fail":
+        raise DirtyReactorError.from_leaks(leaks)
+
+    check.dirty.append((item.nodeid, leaks))
+
+
+def _create_async_yield_fixture_finalizer(coroutine, request=None):
     def finalizer():
-        _run_inline_callbacks(
-            _tear_it_down,
-            defer.ensureDeferred(coroutine.__anext__()),
-        )
+        phase = None
+        if request is not None:
+            phase = _start_phase(
+                nodeid=_fixture_phase_nodeid(request),
+                name="teardown {}".format(request.fixturename),
+            )
+        try:
+            _run_inline_callbacks(
+                _implementation._tear_it_down,
+                defer.ensureDeferred(coroutine.__anext__()),
+            )
+        finally:
+            _finish_phase(phase)
 
     return finalizer
 
 
-@defer.inlineCallbacks
-def _tear_it_down(deferred):
-    """Tear down a specific async yield fixture."""
-    try:
-        yield deferred
-    except StopAsyncIteration:
-        return
+def _start_inline_callbacks(f, *args):
+    """Schedule a call in the Twisted greenlet without waiting for it.
 
-    # TODO: six.raise_from()
-    raise AsyncGeneratorFixtureDidNotStopError.from_generator(
-        generator=deferred,
-    )
+    Cancelling the returned Deferred cancels the call's own Deferred, or the
+    call itself if it has not started yet.
+    """
+    _ensure_reactor()
+    started = []
+
+    def in_reactor(d, f, *args):
+        started.append(defer.maybeDeferred(f, *args))
+        started[0].addBoth(fire, d)
+
+    def fire(result, d):
+        if not d.called:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def cancel(d):
+        if started:
+            started[0].cancel()
+        elif call.active():
+            call.cancel()
+
+    d = defer.Deferred(cancel)
+    call = _instances.reactor.callLater(0.0, in_reactor, d, f, *args)
+
+    return d
 
 
 def _run_inline_callbacks(f, *args):
     """Interface into Twisted greenlet to run and wait for a deferred."""
+    _ensure_reactor()
     if _instances.gr_twisted is not None:
         if _instances.gr_twisted.dead:
             raise RuntimeError("twisted reactor has stopped")
 
-        def in_reactor(d, f, *args):
-            return defer.maybeDeferred(f, *args).chainDeferred(d)
-
-        d = defer.Deferred()
-        _instances.reactor.callLater(0.0, in_reactor, d, f, *args)
+        d = _start_inline_callbacks(f, *args)
         blockon_default(d)
     else:
         if not _instances.reactor.running:
             raise RuntimeError("twisted reactor is not running")
-        blockingCallFromThread(_instances.reactor, f, *args)
+        _thread_bridge().call(f, *args)
 
 
-def pytest_pyfunc_call(pyfuncitem):
-    """Interface to async test call handler."""
-    # TODO: only handle 'our' tests?  what is the point of handling others?
-    #       well, because our interface allowed people to return deferreds
-    #       from arbitrary tests so we kinda have to keep this up for now
-    maybe_hypothesis = getattr(pyfuncitem.obj, "hypothesis", None)
-    if maybe_hypothesis is None:
-        _run_inline_callbacks(
-            _async_pytest_pyfunc_call,
-            pyfuncitem,
-            pyfuncitem.obj,
-            {}
-        )
-        result = not None
-    else:
-        hypothesis = maybe_hypothesis
-        f = hypothesis.inner_test
+def _call_with_timeout(seconds, f, *args):
+    """Call f in the reactor and cancel its Deferred after seconds.
 
-        def inner_test(**kwargs):
-            return _run_inline_callbacks(
-                _async_pytest_pyfunc_call,
-                pyfuncitem,
-                f,
-                kwargs,
-            )
+    The returned Deferred fails with DeferredTimeoutError on expiry, even when
+    the cancellation is ignored, and the CancelledError raised through the
+    pending call stack becomes its cause.
+    """
+    d = defer.maybeDeferred(f, *args)
+    if not seconds:
+        return d
 
-        pyfuncitem.obj.hypothesis.inner_test = inner_test
-        result = None
+    result = defer.Deferred(lambda _: d.cancel())
+    expired = []
 
-    return result
+    def expire():
+        expired.append(True)
+        d.cancel()
+        if not result.called:
+            result.errback(DeferredTimeoutError.from_seconds(seconds))
 
+    def fire(r):
+        if timer.active():
+            timer.cancel()
 
-@pytest.fixture(scope="session", autouse=True)
-def twisted_greenlet():
-    """Provide the twisted greenlet in fixture form."""
-    return _instances.gr_twisted
+        if result.called:
+            # reported as timed out already, drop the late outcome
+            return None
 
+        if not isinstance(r, failure.Failure):
+            result.callback(r)
+            return None
 
-def init_default_reactor():
-    """Install the default Twisted reactor."""
-    import twisted.internet.default
+        if expired and r.check(defer.CancelledError):
+            e = DeferredTimeoutError.from_seconds(seconds)
+            e.__cause__ = r.value
+            r = failure.Failure(e)
 
-    module = inspect.getmodule(twisted.internet.default.install)
+        result.errback(r)
+        return None
 
-    module_name = module.__name__.split(".")[-1]
-    reactor_type_name, = (x for x in dir(module) if x.lower() == module_name)
-    reactor_type = getattr(module, reactor_type_name)
+    timer = _instances.reactor.callLater(seconds, expire)
+    d.addBoth(fire)
 
-    _install_reactor(
-        reactor_installer=twisted.internet.default.install,
-        reactor_type=reactor_type,
-    )
+    return result
 
 
-def init_qt5_reactor():
-    """Install the qt5reactor...  reactor."""
-    import qt5reactor
+def _test_timeout(item):
+    """Get the timeout for item from its mark or the ini option."""
+    mark = item.get_closest_marker("twisted_timeout")
+    if mark is None:
+        return _config.timeout
 
-    _install_reactor(
-        reactor_installer=qt5reactor.install, reactor_type=qt5reactor.QtReactor
-    )
+    seconds = mark.args[0] if mark.args else mark.kwargs.get("seconds")
 
+    return float(seconds) if seconds else None
 
-def init_asyncio_reactor():
-    """Install the Twisted reactor for asyncio."""
-    from twisted.internet import asyncioreactor
 
-    _install_reactor(
-        reactor_installer=asyncioreactor.install,
-        reactor_type=asyncioreactor.AsyncioSelectorReactor,
-    )
+def _call_test(f, kwargs):
+    return f(**kwargs)
 
 
-reactor_installers = {
-    "default": init_default_reactor,
-    "qt5reactor": init_qt5_reactor,
-    "asyncio": init_asyncio_reactor,
-}
+def _call_async_test(f, kwargs):
+    return defer.ensureDeferred(f(**kwargs))
 
 
-def _install_reactor(reactor_installer, reactor_type):
+class _Dispatch(object):
+    """How to run a test, worked out once when it is collected.
+
+    kind is one of sync, hypothesis, async, inline_callbacks or deferred.
+    The latter is for unmarked tests which are run in the reactor and may
+    return a Deferred.  call runs f with the test arguments in the reactor.
+    """
+
+    def __init__(self, item):
+        obj = item.obj
+        hypothesis = getattr(obj, "hypothesis", None)
+        self.f = obj if hypothesis is None else hypothesis.inner_test
+        self.argnames = tuple(item._fixtureinfo.argnames)
+        self.timeout = _test_timeout(item)
+
+        mark = _get_mark(self.f)
+        if mark == "async_test":
+            self.call = _call_async_test
+        else:
+            self.call = _call_test
+
+        if hypothesis is not None:
+            self.kind = "hypothesis"
+        elif mark == "async_test":
+            self.kind = "async"
+        elif mark == "inline_callbacks_test":
+            self.kind = "inline_callbacks"
+        elif _config.sync_fast_path and _is_plain_sync_test(obj):
+            self.kind = "sync"
+        else:
+            self.kind = "deferred"
+
+    def kwargs(self, pyfuncitem):
+        """Get the fixture values the test function takes."""
+        funcargs = pyfuncitem.funcargs
+        return {name: funcargs[name] for name in self.argnames}
+
+
+def _dispatch_for(item):
+    """Get the dispatch of item, for items added after collection as well."""
+    dispatch = getattr(item, "_pytest_twisted_dispatch", None)
+    if dispatch is None:
+        dispatch = _Dispatch(item)
+        item._pytest_twisted_dispatch = dispatch
+
+    return dispatch
+
+
+def _start_test(pyfuncitem, kwargs):
+    """Start a test in the reactor without waiting for it."""
+    dispatch = _dispatch_for(pyfuncitem)
+
+    return _start_inline_callbacks(
+        _call_with_timeout,
+        dispatch.timeout,
+        dispatch.call,
+        dispatch.f,
+        kwargs,
+    )
+
+
+def _callspec_param(item, name, default=None):
+    """Get the parametrized value of name for item, if any."""
+    callspec = getattr(item, "callspec", None)
+    if callspec is None:
+        return default
+
+    for mapping in (callspec.params, getattr(callspec, "funcargs", {})):
+        if name in mapping:
+            return mapping[name]
+
+    return default
+
+
+def _only_builtin_setup_hooks(item):
+    """Check that no conftest or plugin setup hook could skip item.
+
+    Tests started early run before their own setup, so only pytest's and
+    pytest-twisted's own pytest_runtest_setup implementations are allowed.
+    """
+    hook = item.ihook.pytest_runtest_setup
+    get_hookimpls = getattr(hook, "get_hookimpls", None)
+    if get_hookimpls is None:
+        return False
+
+    for hookimpl in get_hookimpls():
+        plugin = hookimpl.plugin
+        if inspect.ismodule(plugin):
+            name = plugin.__name__
+        else:
+            name = type(plugin).__module__
+        if name != __name__ and not name.startswith("_pytest."):
+            return False
+
+    return True
+
+
+def _concurrent_kwargs(reference, candidate):
+    """Build the test arguments for starting candidate while reference runs.
+
+    Only tests which share every fixture value with the running reference
+    test can be started early.  Function scoped fixtures, skip and xfail
+    marks, pytest_runtest_setup hooks of conftest files or other plugins and
+    hypothesis tests all make a candidate ineligible in which case None is
+    returned.
+    """
+    fixtureinfo = getattr(candidate, "_fixtureinfo", None)
+    if fixtureinfo is None or candidate.parent is not reference.parent:
+        return None
+
+    if _dispatch_for(candidate).kind not in ("async", "inline_callbacks"):
+        return None
+
+    for name in ("skip", "skipif", "xfail"):
+        if candidate.get_closest_marker(name) is not None:
+            return None
+
+    if not _only_builtin_setup_hooks(candidate):
+        return None
+
+    missing = object()
+    reference_fixturedefs = reference._fixtureinfo.name2fixturedefs
+    kwargs = {}
+    for name in candidate.fixturenames:
+        fixturedefs = fixtureinfo.name2fixturedefs.get(name)
+        param = _callspec_param(candidate, name, missing)
+        if param is not missing and not fixturedefs:
+            kwargs[name] = param
+            continue
+
+        if not fixturedefs:
+            return None
+
+        fixturedef = fixturedefs[-1]
+        fixture_function_name = getattr(fixturedef.func, "__name__", None)
+        if fixture_function_name == "get_direct_param_fixture_func":
+            kwargs[name] = param
+            continue
+
+        if fixturedef.scope == "function" or name not in reference.funcargs:
+            return None
+
+        if reference_fixturedefs.get(name, [None])[-1] is not fixturedef:
+            return None
+
+        if _callspec_param(reference, name, missing) != param:
+            return None
+
+        kwargs[name] = reference.funcargs[name]
+
+    return {name: kwargs[name] for name in fixtureinfo.argnames}
+
+
+def _start_concurrent_tests(pyfuncitem):
+    """Start the following eligible tests up to the concurrency limit."""
+    index = _concurrency.index.get(pyfuncitem)
+    if index is None:
+        return
+
+    following = _concurrency.items[index + 1:index + _concurrency.limit]
+    for candidate in following:
+        if candidate in _concurrency.pending:
+            continue
+
+        if len(_concurrency.pending) + 1 >= _concurrency.limit:
+            break
+
+        kwargs = _concurrent_kwargs(reference=pyfuncitem, candidate=candidate)
+        if kwargs is None:
+            break
+
+        d = _start_test(candidate, kwargs)
+        _trace_deferred(nodeid=candidate.nodeid, name="run", d=d)
+        _concurrency.pending[candidate] = d
+
+
+def _run_concurrently(pyfuncitem, dispatch):
+    """Wait for this test while letting the following ones start."""
+    d = _concurrency.pending.pop(pyfuncitem, None)
+    if d is None:
+        if dispatch.kind not in ("async", "inline_callbacks"):
+            return False
+
+        d = _start_test(pyfuncitem, dispatch.kwargs(pyfuncitem))
+
+    _start_concurrent_tests(pyfuncitem)
+    blockon_default(d)
+
+    return True
+
+
+def _is_plain_sync_test(f):
+    """Check if f is neither marked nor obviously asynchronous."""
+    if _get_mark(f) is not None or getattr(f, "hypothesis", None) is not None:
+        return False
+
+    if inspect.isgeneratorfunction(f):
+        return False
+
+    # inspect.iscoroutinefunction() is not available on Python 2
+    iscoroutinefunction = getattr(inspect, "iscoroutinefunction", None)
+
+    return iscoroutinefunction is None or not iscoroutinefunction(f)
+
+
+def _run_sync_test(pyfuncitem, dispatch):
+    """Call a plain test directly and only block if it returns a Deferred."""
+    result = dispatch.f(**dispatch.kwargs(pyfuncitem))
+    if isinstance(result, defer.Deferred):
+        if dispatch.timeout:
+            _run_inline_callbacks(
+                _call_with_timeout,
+                dispatch.timeout,
+                lambda x: x,
+                result,
+            )
+        else:
+            blockon(result)
+
+
+def _run_hypothesis_example(dispatch, kwargs):
+    """Run an example in the calling greenlet, only waiting if it must.
+
+    Examples completing synchronously go back to Hypothesis right away with
+    no reactor round trip and exceptions propagate unchanged for shrinking.
+    """
+    if dispatch.timeout:
+        result = _call_with_timeout(
+            dispatch.timeout,
+            dispatch.call,
+            dispatch.f,
+            kwargs,
+        )
+    else:
+        result = dispatch.call(dispatch.f, kwargs)
+
+    if isinstance(result, defer.Deferred):
+        result = blockon_default(result)
+
+    return result
+
+
+class _ConcurrentExamples(object):
+    """Start Hypothesis examples without waiting for them to complete.
+
+    inner_test() only waits while the concurrency limit is reached so
+    Hypothesis carries on generating examples.  After the first failure the
+    remaining examples are skipped.
+    """
+
+    def __init__(self, pyfuncitem, dispatch, limit):
+        from hypothesis.errors import UnsatisfiedAssumption
+
+        self.pyfuncitem = pyfuncitem
+        self.dispatch = dispatch
+        self.failure = None
+        self._rejected = UnsatisfiedAssumption
+        self._semaphore = defer.DeferredSemaphore(limit)
+        self._running = set()
+
+    def inner_test(self, **kwargs):
+        if self.failure is not None:
+            return
+
+        dispatch = self.dispatch
+        kwargs.update(dispatch.kwargs(self.pyfuncitem))
+        blockon_default(self._semaphore.acquire())
+
+        rejected = []
+        d = defer.maybeDeferred(
+            _call_with_timeout,
+            dispatch.timeout,
+            dispatch.call,
+            dispatch.f,
+            kwargs,
+        )
+        self._running.add(d)
+        _trace_deferred(nodeid=self.pyfuncitem.nodeid, name="example", d=d)
+        d.addBoth(self._finished, d, rejected)
+        if rejected:
+            # let Hypothesis know about assume() failing right away
+            rejected[0].raiseException()
+
+    def _finished(self, result, d, rejected):
+        self._running.discard(d)
+        self._semaphore.release()
+        if isinstance(result, failure.Failure):
+            if result.check(self._rejected):
+                rejected.append(result)
+            elif self.failure is None:
+                self.failure = result
+
+    def wait(self):
+        """Wait for the examples still running."""
+        while self._running:
+            blockon_default(defer.DeferredList(list(self._running)))
+
+
+def _hypothesis_allows_concurrency(test):
+    """Check for the Hypothesis internals concurrent examples rely on.
+
+    The seed and settings of a test and its replaceable inner test are not
+    public, Hypothesis versions without them run examples one at a time.
+    """
+    inner = getattr(test, "hypothesis", None)
+    names = (
+        "_hypothesis_internal_use_seed",
+        "_hypothesis_internal_use_settings",
+    )
+    return hasattr(inner, "inner_test") and all(
+        hasattr(test, name) for name in names
+    )
+
+
+def _run_hypothesis_concurrently(pyfuncitem, dispatch, sequential_inner_test):
+    """Run the examples concurrently and rerun them one by one on failure.
+
+    Both runs use the same seed so the sequential run reaches the failing
+    example and shrinks it as usual.  Failures only seen while running
+    concurrently, such as drawing from a frozen ``data()`` after a wait, are
+    dropped when the sequential run passes.  Returns False if the installed
+    Hypothesis does not allow this.
+    """
+    test = pyfuncitem.obj
+    if not _hypothesis_allows_concurrency(test):
+        return False
+
+    seed = test._hypothesis_internal_use_seed
+    settings = test._hypothesis_internal_use_settings
+
+    import hypothesis
+
+    testargs = dispatch.kwargs(pyfuncitem)
+    examples = _ConcurrentExamples(
+        pyfuncitem=pyfuncitem,
+        dispatch=dispatch,
+        limit=_concurrency.hypothesis_limit,
+    )
+
+    if seed is None:
+        test._hypothesis_internal_use_seed = random.getrandbits(128)
+
+    try:
+        # waiting for a free slot must not count against the deadline
+        test._hypothesis_internal_use_settings = hypothesis.settings(
+            settings,
+            deadline=None,
+        )
+        test.hypothesis.inner_test = examples.inner_test
+        phase = _start_phase(nodeid=pyfuncitem.nodeid, name="call")
+        try:
+            test(**testargs)
+        finally:
+            examples.wait()
+            _finish_phase(phase)
+            test._hypothesis_internal_use_settings = settings
+            test.hypothesis.inner_test = sequential_inner_test
+
+        if examples.failure is not None:
+            test(**testargs)
+    finally:
+        test._hypothesis_internal_use_seed = seed
+
+    return True
+
+
+def pytest_pyfunc_call(pyfuncitem):
+    """Interface to async test call handler."""
+    # TODO: only handle 'our' tests?  what is the point of handling others?
+    #       well, because our interface allowed people to return deferreds
+    #       from arbitrary tests so we kinda have to keep this up for now
+    dispatch = _dispatch_for(pyfuncitem)
+    if dispatch.kind == "sync":
+        phase = _start_phase(nodeid=pyfuncitem.nodeid, name="call")
+        try:
+            _run_sync_test(pyfuncitem, dispatch)
+        finally:
+            _finish_phase(phase)
+        return not None
+
+    _ensure_reactor()
+    if dispatch.kind != "hypothesis":
+        greenlet_mode = _instances.gr_twisted is not None
+        concurrent = greenlet_mode and _concurrency.limit > 1
+        phase = _start_phase(nodeid=pyfuncitem.nodeid, name="call")
+        try:
+            if not (concurrent and _run_concurrently(pyfuncitem, dispatch)):
+                _run_inline_callbacks(
+                    _call_with_timeout,
+                    dispatch.timeout,
+                    dispatch.call,
+                    dispatch.f,
+                    dispatch.kwargs(pyfuncitem),
+                )
+        finally:
+            _finish_phase(phase)
+        result = not None
+    else:
+        greenlet_mode = _instances.gr_twisted is not None
+        direct = greenlet_mode and _config.sync_fast_path
+
+        def inner_test(**kwargs):
+            kwargs.update(dispatch.kwargs(pyfuncitem))
+            phase = _start_phase(nodeid=pyfuncitem.nodeid, name="call")
+            try:
+                if direct:
+                    return _run_hypothesis_example(dispatch, kwargs)
+
+                return _run_inline_callbacks(
+                    _call_with_timeout,
+                    dispatch.timeout,
+                    dispatch.call,
+                    dispatch.f,
+                    kwargs,
+                )
+            finally:
+                _finish_phase(phase)
+
+        concurrent = greenlet_mode and _concurrency.hypothesis_limit > 1
+        if concurrent and _run_hypothesis_concurrently(
+            pyfuncitem=pyfuncitem,
+            dispatch=dispatch,
+            sequential_inner_test=inner_test,
+        ):
+            return not None
+
+        pyfuncitem.obj.hypothesis.inner_test = inner_test
+        result = None
+
+    return result
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_collection(session):
+    """Record the collection in the trace."""
+    trace = _observers.trace
+    if trace is None:
+        yield
+        return
+
+    phase = (None, "collection")
+    trace.phase_started(phase)
+    try:
+        yield
+    finally:
+        trace.phase_finished(phase)
+
+
+def pytest_collection_modifyitems(session, config, items):
+    """Work out how each test is run once instead of on every call."""
+    for item in items:
+        if isinstance(item, pytest.Function):
+            item._pytest_twisted_dispatch = _Dispatch(item)
+
+
+def _max_blocking_limit(nodeid, mark):
+    """Get the milliseconds of a twisted_max_blocking mark."""
+    if len(mark.args) + len(mark.kwargs) == 1:
+        limit = mark.args[0] if mark.args else mark.kwargs.get("ms")
+    else:
+        limit = None
+
+    valid = isinstance(limit, (int, float)) and not isinstance(limit, bool)
+    if not valid or limit < 0:
+        raise pytest.UsageError(
+            "{}: twisted_max_blocking takes a number of milliseconds,"
+            " got args {!r} and kwargs {!r}".format(
+                nodeid,
+                mark.args,
+                mark.kwargs,
+            ),
+        )
+
+    return limit
+
+
+def pytest_collection_finish(session):
+    """Index the collected items for concurrent test execution."""
+    if _concurrency.limit > 1:
+        _concurrency.items = list(session.items)
+        _concurrency.index = {
+            item: index
+            for index, item in enumerate(_concurrency.items)
+        }
+
+    _config.max_blocking = {}
+    for item in session.items:
+        mark = item.get_closest_marker("twisted_max_blocking")
+        if mark is not None:
+            _config.max_blocking[item.nodeid] = _max_blocking_limit(
+                nodeid=item.nodeid,
+                mark=mark,
+            )
+    if _config.max_blocking:
+        _config.monitor_callbacks = True
+        if _instances.reactor is not None:
+            _install_callback_monitor()
+
+
+def pytest_runtest_logstart(nodeid):
+    """Attribute the following reactor work and log events to this test.
+
+    Pytest fills the test's fixtures next, until pytest_runtest_setup() ends.
+    """
+    _concurrency.filling_fixtures = True
+    if _instances.log_events is not None:
+        _instances.log_events.clear()
+
+    profiler = _observers.profiler
+    if profiler is not None:
+        profiler.nodeid = nodeid
+
+    check = _instances.reactor_check
+    if check is not None:
+        check.baseline = None
+
+    monitor = _instances.callback_monitor
+    if monitor is not None:
+        monitor.nodeid = nodeid
+        monitor.worst = None
+        # only tests with a max_blocking mark pay for timing their callbacks
+        limited = nodeid in _config.max_blocking
+        monitor.active = limited or monitor.threshold is not None
+
+
+def pytest_runtest_logfinish(nodeid):
+    """Clean the failures kept for the reports of this test."""
+    _clean_reported_failures()
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    """Attach the test's last twisted.logger events to a failure report."""
+    outcome = yield
+    events = _instances.log_events
+    if events is None or not events.events:
+        return
+
+    report = outcome.get_result()
+    if report.failed:
+        report.sections.append(
+            ("Captured twisted log {}".format(report.when), events.format()),
+        )
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_runtest_call(item):
+    """Fail a test whose reactor callbacks blocked beyond max_blocking."""
+    monitor = _instances.callback_monitor
+    if monitor is None or monitor.worst is None:
+        return
+
+    limit = _config.max_blocking.get(item.nodeid)
+    if limit is None:
+        return
+
+    seconds, owner = monitor.worst
+    if seconds * 1000 > limit:
+        raise ReactorBlockedError.from_callback(
+            description=_describe_callable(owner),
+            seconds=seconds,
+            limit=limit,
+        )
+
+
+def pytest_sessionfinish(session):
+    """Discard tests which were started early but never reported.
+
+    Stop memory tracing and write out the reactor profiles and the trace.
+    """
+    pending = list(_concurrency.pending.values())
+    _concurrency.pending.clear()
+    for d in pending:
+        d.addErrback(lambda _: None)
+        d.cancel()
+
+    if _observers.memory is not None:
+        _observers.memory.stop()
+
+    profiler = _observers.profiler
+    if profiler is not None:
+        profiler.write()
+
+    trace = _observers.trace
+    if trace is not None:
+        trace.write()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def twisted_greenlet():
+    """Provide the twisted greenlet in fixture form."""
+    return _instances.gr_twisted
+
+
+def _internal_selectables(reactor):
+    """Get the reactor's own wakers which are not work started by tests."""
+    internal = set(getattr(reactor, "_internalReaders", ()))
+    internal.add(getattr(reactor, "waker", None))
+    internal.add(getattr(reactor, "_childWaker", None))
+
+    return internal
+
+
+def _reactor_has_pending_work(reactor):
+    """Check for I/O and thread work which could wake up the reactor.
+
+    Delayed calls are not considered.  The reactor's own wakers are ignored.
+    """
+    internal = _internal_selectables(reactor)
+    readers, writers = reactor.getReaders(), reactor.getWriters()
+    for selectable in itertools.chain(readers, writers):
+        if selectable not in internal:
+            return True
+
+    if getattr(reactor, "threadCallQueue", None):
+        return True
+
+    threadpool = getattr(reactor, "threadpool", None)
+    if threadpool is not None:
+        queue = getattr(threadpool, "_queue", getattr(threadpool, "q", None))
+        if threadpool.working or (queue is not None and queue.qsize()):
+            return True
+
+    return False
+
+
+def _threadpool_jobs(reactor):
+    threadpool = getattr(reactor, "threadpool", None)
+    if threadpool is None:
+        return 0
+
+    queue = getattr(threadpool, "_queue", getattr(threadpool, "q", None))
+    queued = 0 if queue is None else queue.qsize()
+
+    return len(threadpool.working) + queued
+
+
+def _reactor_state(reactor):
+    """Capture the delayed calls, readers, writers and thread pool jobs."""
+    return (
+        reactor.getDelayedCalls(),
+        reactor.getReaders(),
+        reactor.getWriters(),
+        _threadpool_jobs(reactor),
+    )
+
+
+class _DirtyReactorCheck(object):
+    """Find work a test left in the reactor after its teardown.
+
+    The state after setup is the baseline so fixtures of wider scope set up
+    for the test are not blamed on it.  Only work added since then counts,
+    an unchanged state is recognized without looking at the individual items.
+    """
+
+    def __init__(self):
+        self.baseline = None
+        self.dirty = []
+
+    def _state(self):
+        reactor = _instances.reactor
+        if _config.external_reactor:
+            return _thread_bridge().call(_reactor_state, reactor)
+
+        return _reactor_state(reactor)
+
+    def start(self):
+        if _instances.reactor is None:
+            self.baseline = None
+        else:
+            self.baseline = self._state()
+
+    def finish(self):
+        """Describe the work added since start(), if any."""
+        baseline, self.baseline = self.baseline, None
+        if baseline is None or _concurrency.pending:
+            # tests started early are still running in the reactor
+            return []
+
+        state = self._state()
+        if state == baseline:
+            return []
+
+        calls, readers, writers, jobs = state
+        before_calls, before_readers, before_writers, before_jobs = baseline
+        before_calls = set(id(call) for call in before_calls)
+        before_selectables = set(
+            id(selectable)
+            for selectable in itertools.chain(
+                before_readers,
+                before_writers,
+                _internal_selectables(_instances.reactor),
+            )
+        )
+
+        now = _instances.reactor.seconds()
+        leaks = [
+            "delayed call {} due in {:.3f}s".format(
+                _describe_callable(call.func),
+                call.getTime() - now,
+            )
+            for call in calls
+            if id(call) not in before_calls
+        ]
+        leaks.extend(
+            "{} {!r}".format(kind, selectable)
+            for kind, selectables in (("reader", readers), ("writer", writers))
+            for selectable in selectables
+            if id(selectable) not in before_selectables
+        )
+        if jobs > before_jobs:
+            leaks.append("{} thread pool jobs".format(jobs - before_jobs))
+
+        return leaks
+
+    def report(self, terminalreporter):
+        terminalreporter.write_sep("=", "twisted dirty reactor")
+        for nodeid, leaks in self.dirty:
+            terminalreporter.write_line(nodeid)
+            for leak in leaks:
+                terminalreporter.write_line("    {}".format(leak))
+
+
+class _VirtualClock(object):
+    """Reactor time which skips ahead while only delayed calls are pending.
+
+    The reactor's seconds() is replaced for the rest of the session so that
+    time never goes backwards.  Delayed calls scheduled before then are
+    switched over as well so that resetting them uses the virtual time.
+    Skipping only happens while advancing is set.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.offset = 0.0
+        self.advancing = False
+        self._real_seconds = reactor.seconds
+        self._real_timeout = reactor.timeout
+        self._real_run_until_current = reactor.runUntilCurrent
+        reactor.seconds = self.seconds
+        for call in reactor.getDelayedCalls():
+            call.seconds = self.seconds
+        reactor.timeout = self._timeout
+        reactor.runUntilCurrent = self._run_until_current
+
+    def seconds(self):
+        """Get the current virtual reactor time."""
+        return self._real_seconds() + self.offset
+
+    def advance(self, amount):
+        """Move the virtual time forward by amount seconds."""
+        self.offset += amount
+
+    def _can_skip(self):
+        return self.advancing and not _reactor_has_pending_work(self.reactor)
+
+    def _timeout(self):
+        timeout = self._real_timeout()
+        if timeout and self._can_skip():
+            return 0.0
+
+        return timeout
+
+    def _run_until_current(self):
+        if self._can_skip():
+            timeout = self._real_timeout()
+            if timeout:
+                self.advance(timeout)
+
+        self._real_run_until_current()
+
+
+@pytest.fixture
+def twisted_virtual_time():
+    """Fast-forward the reactor to the next delayed call when otherwise idle.
+
+    Provides the virtual clock.  Time only skips while there are no readers,
+    writers or thread pool work which could wake the reactor up sooner.
+    """
+    _ensure_reactor()
+    if _instances.gr_twisted is None:
+        raise RuntimeError("virtual time requires the twisted greenlet")
+
+    if _instances.virtual_clock is None:
+        _instances.virtual_clock = _VirtualClock(_instances.reactor)
+
+    clock = _instances.virtual_clock
+    clock.advancing = True
+    try:
+        yield clock
+    finally:
+        clock.advancing = False
+
+
+class _DurationsRecorder(object):
+    """Collect wall time, reactor time and greenlet switches per phase.
+
+    Reactor time is the time the twisted greenlet was running.  Repeated
+    phases, such as Hypothesis examples, are added up.
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self._stack = []
+        self._reactor_time = 0.0
+        self._entered = None
+        self._switches = 0
+
+    def switch(self, origin, target):
+        self._switches += 1
+        if target is _instances.gr_twisted:
+            self._entered = timeit.default_timer()
+        elif origin is _instances.gr_twisted and self._entered is not None:
+            self._reactor_time += timeit.default_timer() - self._entered
+            self._entered = None
+
+    def _counters(self):
+        now = timeit.default_timer()
+        reactor_time = self._reactor_time
+        if self._entered is not None:
+            reactor_time += now - self._entered
+
+        return now, reactor_time, self._switches
+
+    def phase_started(self, phase):
+        self._stack.append((phase, self._counters()))
+
+    def phase_finished(self, phase):
+        started_phase, started = self._stack.pop()
+        assert started_phase == phase, "phases finished out of order"
+
+        finished = self._counters()
+        total = self.totals.setdefault(phase, [0.0, 0.0, 0])
+        for index, (start, end) in enumerate(zip(started, finished)):
+            total[index] += end - start
+
+    def report(self, terminalreporter, count):
+        totals = sorted(
+            self.totals.items(),
+            key=lambda item: item[1][0],
+            reverse=True,
+        )
+        if count > 0:
+            title = "slowest {} twisted phases".format(count)
+            totals = totals[:count]
+        else:
+            title = "twisted phases"
+
+        terminalreporter.write_sep("=", title)
+        for (nodeid, name), (wall, reactor_time, switches) in totals:
+            terminalreporter.write_line(
+                "{:.2f}s wall {:.2f}s reactor {:>5} switches  {:<20} {}"
+                .format(wall, reactor_time, switches, name, nodeid),
+            )
+
+
+class _ReactorProfiler(object):
+    """Profile the code run while the twisted greenlet is active.
+
+    Each test gets its own profile, reactor time outside of tests is
+    collected under the session profile.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.nodeid = None
+        self.profiles = {}
+        self.written = None
+        self._active = None
+
+    def switch(self, origin, target):
+        if _instances.gr_twisted is None or self.written is not None:
+            return
+
+        if target is _instances.gr_twisted:
+            import cProfile
+
+            profile = self.profiles.get(self.nodeid)
+            if profile is None:
+                profile = cProfile.Profile()
+                self.profiles[self.nodeid] = profile
+            self._active = profile
+            profile.enable()
+        elif origin is _instances.gr_twisted and self._active is not None:
+            self._active.disable()
+            self._active = None
+
+    def _path(self, nodeid):
+        if nodeid is None:
+            name = "session"
+        else:
+            name = re.sub(r"[^\w.-]+", "_", nodeid).strip("_")
+
+        return os.path.join(self.directory, name + ".prof")
+
+    def write(self):
+        """Write a pstats file per test and a combined one for all of them.
+
+        Profiling stops, the number of files per test is kept in written.
+        """
+        import pstats
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        combined = None
+        written = 0
+        for nodeid, profile in sorted(
+            self.profiles.items(),
+            key=lambda item: item[0] or "",
+        ):
+            if not profile.getstats():
+                continue
+
+            stats = pstats.Stats(profile)
+            stats.dump_stats(self._path(nodeid))
+            if nodeid is not None:
+                written += 1
+            if combined is None:
+                combined = stats
+            else:
+                combined.add(stats)
+
+        if combined is not None:
+            combined.dump_stats(os.path.join(self.directory, "combined.prof"))
+
+        self.profiles.clear()
+        self.written = written
+
+
+class _TraceRecorder(object):
+    """Record spans of phases and reactor greenlet activity for a timeline.
+
+    The spans are written in the Chrome trace event format which also loads
+    in speedscope and Perfetto.  Overlapping spans which are not nested, such
+    as concurrently set up fixtures, are spread over as many lanes as needed.
+    """
+
+    lanes = ("pytest", "twisted greenlet")
+
+    def __init__(self, path):
+        self.path = path
+        self.spans = []
+        self.written = False
+        self._stack = []
+        self._entered = None
+
+    def _now(self):
+        return timeit.default_timer()
+
+    def phase_started(self, phase):
+        self._stack.append((phase, self._now()))
+
+    def phase_finished(self, phase):
+        started_phase, start = self._stack.pop()
+        assert started_phase == phase, "phases finished out of order"
+
+        nodeid, name = phase
+        self.spans.append(("pytest", name, nodeid, start, self._now()))
+
+    def deferred_span(self, nodeid, name, d):
+        start = self._now()
+
+        def finished(result):
+            self.spans.append(("pytest", name, nodeid, start, self._now()))
+            return result
+
+        d.addBoth(finished)
+
+    def switch(self, origin, target):
+        if _instances.gr_twisted is None:
+            return
+
+        if target is _instances.gr_twisted:
+            self._entered = self._now()
+        elif origin is _instances.gr_twisted and self._entered is not None:
+            self.spans.append(
+                ("twisted greenlet", "reactor", None, self._entered,
+                 self._now()),
+            )
+            self._entered = None
+
+    def _events(self):
+        """Convert the spans to complete events, each lane nesting properly."""
+        if not self.spans:
+            return []
+
+        origin = min(start for _, _, _, start, _ in self.spans)
+        open_lanes = {name: [] for name in self.lanes}
+        tids = {}
+        events = []
+        for lane, name, nodeid, start, end in sorted(
+            self.spans,
+            key=lambda span: (span[3], -span[4]),
+        ):
+            # each lane holds the end times of its still open spans
+            for index, ends in enumerate(open_lanes[lane]):
+                while ends and ends[-1] <= start:
+                    ends.pop()
+                if not ends or end <= ends[-1]:
+                    break
+            else:
+                index = len(open_lanes[lane])
+                ends = []
+                open_lanes[lane].append(ends)
+            ends.append(end)
+
+            tid = tids.setdefault((lane, index), len(tids) + 1)
+            event = {
+                "name": name,
+                "cat": lane,
+                "ph": "X",
+                "pid": 1,
+                "tid": tid,
+                "ts": (start - origin) * 1e6,
+                "dur": (end - start) * 1e6,
+            }
+            if nodeid is not None:
+                event["name"] = "{} {}".format(name, nodeid)
+                event["args"] = {"nodeid": nodeid}
+            events.append(event)
+
+        for (lane, index), tid in tids.items():
+            events.append({
+                "name": "thread_name",
+                "ph": "M",
+                "pid": 1,
+                "tid": tid,
+                "args": {"name": "{} {}".format(lane, index + 1)},
+            })
+            events.append({
+                "name": "thread_sort_index",
+                "ph": "M",
+                "pid": 1,
+                "tid": tid,
+                "args": {"sort_index": tid},
+            })
+
+        return events
+
+    def write(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with open(self.path, "w") as f:
+            json.dump(
+                {"traceEvents": self._events(), "displayTimeUnit": "ms"},
+                f,
+            )
+
+        self.spans = []
+        self.written = True
+
+
+class _MemoryTracer(object):
+    """Track the memory each test's phases leave allocated with tracemalloc.
+
+    The traces are cleared when an outermost phase starts and the blocks
+    still allocated when it finishes are attributed to the test, including
+    those allocated by reactor callbacks in the meantime.  Only the lines
+    which allocated the most are kept per test.
+    """
+
+    kept_lines = 10
+
+    def __init__(self):
+        import tracemalloc
+
+        self.tracemalloc = tracemalloc
+        self.started_tracing = False
+        self.stopped = False
+        self.filters = (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        )
+        self.growth = {}
+        self._depth = 0
+
+    def phase_started(self, phase):
+        self._depth += 1
+        if self._depth > 1 or self.stopped:
+            return
+
+        if not self.tracemalloc.is_tracing():
+            self.tracemalloc.start()
+            self.started_tracing = True
+        self.tracemalloc.clear_traces()
+
+    def phase_finished(self, phase):
+        self._depth -= 1
+        if self._depth > 0 or self.stopped:
+            return
+
+        snapshot = self.tracemalloc.take_snapshot().filter_traces(self.filters)
+        nodeid, _ = phase
+        total, lines = self.growth.get(nodeid, (0, {}))
+        for statistic in snapshot.statistics("lineno"):
+            total += statistic.size
+            frame = statistic.traceback[0]
+            line = "{}:{}".format(frame.filename, frame.lineno)
+            lines[line] = lines.get(line, 0) + statistic.size
+
+        kept = sorted(lines.items(), key=lambda item: item[1], reverse=True)
+        self.growth[nodeid] = (total, dict(kept[:self.kept_lines]))
+
+    def stop(self):
+        self.stopped = True
+        if self.started_tracing and self.tracemalloc.is_tracing():
+            self.tracemalloc.stop()
+
+    def report(self, terminalreporter, count):
+        growth = sorted(
+            self.growth.items(),
+            key=lambda item: item[1][0],
+            reverse=True,
+        )
+        if count > 0:
+            title = "{} tests leaving the most twisted memory".format(count)
+            growth = growth[:count]
+        else:
+            title = "twisted memory left allocated"
+
+        terminalreporter.write_sep("=", title)
+        for nodeid, (total, lines) in growth:
+            terminalreporter.write_line(
+                "{:.1f} KiB {}".format(total / 1024.0, nodeid),
+            )
+            top = sorted(lines.items(), key=lambda item: item[1], reverse=True)
+            for line, size in top[:3]:
+                terminalreporter.write_line(
+                    "    {:.1f} KiB {}".format(size / 1024.0, line),
+                )
+
+
+def _describe_callable(f):
+    if isinstance(f, tuple):
+        return ", ".join(_describe_callable(each) for each in f)
+
+    name = getattr(f, "__qualname__", getattr(f, "__name__", None))
+    if name is None:
+        return repr(f)
+
+    module = getattr(f, "__module__", None)
+    if module is None:
+        return name
+
+    return "{}.{}".format(module, name)
+
+
+class _CallbackMonitor(object):
+    """Time the callbacks run by the reactor.
+
+    Each runUntilCurrent() pass, which runs the due delayed calls and calls
+    from threads, is timed as a whole and described by those callables.  I/O
+    handlers dispatched through log.callWithLogger() are timed one by one.
+    The scheduled calls themselves are left untouched.  Time spent in other
+    greenlets while a callback switched away from the reactor greenlet is
+    not counted.  Nothing is timed while active is false.
+    """
+
+    def __init__(self, reactor, threshold):
+        self.threshold = threshold
+        self.active = threshold is not None
+        self.nodeid = None
+        self.worst = None
+        self.slow = []
+        self._running = []
+
+        real_run_until_current = reactor.runUntilCurrent
+        real_call_with_logger = log.callWithLogger
+
+        def runUntilCurrent():
+            if not self.active:
+                return real_run_until_current()
+
+            due = self._due(reactor)
+            if not due:
+                return real_run_until_current()
+
+            return self._timed(due, real_run_until_current, (), {})
+
+        def callWithLogger(logger, f, *args, **kwargs):
+            if not self.active:
+                return real_call_with_logger(logger, f, *args, **kwargs)
+
+            return self._timed(
+                logger,
+                real_call_with_logger,
+                (logger, f) + args,
+                kwargs,
+            )
+
+        reactor.runUntilCurrent = runUntilCurrent
+        log.callWithLogger = callWithLogger
+
+    @staticmethod
+    def _due(reactor):
+        """Get the callables the next runUntilCurrent() pass will run."""
+        now = reactor.seconds()
+        due = [
+            call.func
+            for call in reactor.getDelayedCalls()
+            if call.getTime() <= now
+        ]
+        due.extend(f for f, _, _ in getattr(reactor, "threadCallQueue", ()))
+
+        return tuple(due)
+
+    def switch(self, origin, target):
+        now = timeit.default_timer()
+        if origin is _instances.gr_twisted:
+            for running in self._running:
+                running[2] += now - running[3]
+                self._record(running)
+        elif target is _instances.gr_twisted:
+            for running in self._running:
+                running[3] = now
+
+    def _record(self, running):
+        """Update the worst and slow callbacks with running so far.
+
+        A callback may only finish long after it blocked the reactor, e.g.
+        once the test waiting for it is done, so it is recorded right away.
+        """
+        owner, nodeid, seconds, _, slow = running
+        if nodeid == self.nodeid:
+            if self.worst is None or seconds > self.worst[0]:
+                self.worst = (seconds, owner)
+
+        if slow or self.threshold is None or seconds < self.threshold:
+            return
+
+        running[4] = True
+        self.slow.append(running)
+
+    def _timed(self, owner, f, args, kwargs):
+        # owner, test node id, seconds so far, time last resumed, slow
+        running = [owner, self.nodeid, 0.0, timeit.default_timer(), False]
+        self._running.append(running)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            self._running.pop()
+            running[2] += timeit.default_timer() - running[3]
+            self._record(running)
+
+    def report(self, terminalreporter):
+        terminalreporter.write_sep(
+            "=",
+            "reactor callbacks over {:.0f} ms".format(self.threshold * 1000),
+        )
+        slow = sorted(self.slow, key=lambda running: running[2], reverse=True)
+        for owner, nodeid, seconds, _, _ in slow:
+            terminalreporter.write_line(
+                "{:.0f} ms {} {}".format(
+                    seconds * 1000,
+                    _describe_callable(owner),
+                    nodeid,
+                ),
+            )
+
+
+def _install_callback_monitor():
+    if _instances.callback_monitor is not None:
+        return
+
+    threshold = None
+    if _config.slow_callback:
+        threshold = _config.slow_callback / 1000.0
+
+    monitor = _CallbackMonitor(
+        reactor=_instances.reactor,
+        threshold=threshold,
+    )
+    _add_switch_listener(monitor.switch)
+    _instances.callback_monitor = monitor
+
+
+class _LogEvents(object):
+    """Keep the last twisted.logger events of the running test.
+
+    Events are only formatted when a failing test's report asks for them.
+    """
+
+    def __init__(self, size):
+        self.events = collections.deque(maxlen=size)
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def clear(self):
+        self.events.clear()
+
+    def format(self):
+        lines = (
+            logger.formatEventAsClassicLogText(event)
+            for event in list(self.events)
+        )
+
+        return "".join(line for line in lines if line is not None)
+
+
+def _install_log_events():
+    if _instances.log_events is not None:
+        return
+
+    events = _LogEvents(size=_config.log_events)
+    logger.globalLogPublisher.addObserver(events)
+    _instances.log_events = events
+
+
+def pytest_terminal_summary(terminalreporter):
+    """Report the slowest phases, reactor callbacks and written files."""
+    recorder = _observers.durations
+    if recorder is not None:
+        count = terminalreporter.config.getoption("twisted_durations")
+        recorder.report(terminalreporter=terminalreporter, count=count)
+
+    monitor = _instances.callback_monitor
+    if monitor is not None and monitor.slow:
+        monitor.report(terminalreporter=terminalreporter)
+
+    profiler = _observers.profiler
+    if profiler is not None and profiler.written is not None:
+        terminalreporter.write_sep(
+            "-",
+            "twisted profiles of {} tests written to {}".format(
+                profiler.written,
+                profiler.directory,
+            ),
+        )
+
+    check = _instances.reactor_check
+    if check is not None and check.dirty:
+        check.report(terminalreporter=terminalreporter)
+
+    memory = _observers.memory
+    if memory is not None:
+        count = terminalreporter.config.getoption("twisted_memtrace")
+        memory.report(terminalreporter=terminalreporter, count=count)
+
+    trace = _observers.trace
+    if trace is not None and trace.written:
+        terminalreporter.write_sep(
+            "-",
+            "twisted trace written to {}".format(trace.path),
+        )
+
+
+def init_default_reactor():
+    """Install the default Twisted reactor."""
+    import twisted.internet.default
+
+    module = inspect.getmodule(twisted.internet.default.install)
+
+    module_name = module.__name__.split(".")[-1]
+    reactor_type_name, = (x for x in dir(module) if x.lower() == module_name)
+    reactor_type = getattr(module, reactor_type_name)
+
+    _install_reactor(
+        reactor_installer=twisted.internet.default.install,
+        reactor_type=reactor_type,
+    )
+
+
+def init_qt5_reactor():
+    """Install the qt5reactor...  reactor."""
+    import qt5reactor
+
+    _install_reactor(
+        reactor_installer=qt5reactor.install, reactor_type=qt5reactor.QtReactor
+    )
+
+
+def init_asyncio_reactor():
+    """Install the Twisted reactor for asyncio."""
+    from twisted.internet import asyncioreactor
+
+    _install_reactor(
+        reactor_installer=asyncioreactor.install,
+        reactor_type=asyncioreactor.AsyncioSelectorReactor,
+    )
+
+
+reactor_installers = {
+    "default": init_default_reactor,
+    "qt5reactor": init_qt5_reactor,
+    "asyncio": init_asyncio_reactor,
+}
+
+
+def _ensure_reactor():
+    """Install the chosen reactor on first use with --twisted-lazy-reactor.
+
+    Returns True if the reactor was installed by this call.
+    """
+    if _instances.reactor is not None or _config.lazy_reactor is None:
+        return False
+
+    reactor_installers[_config.lazy_reactor]()
+
+    fixturedef = _instances.greenlet_fixturedef
+    if fixturedef is not None and fixturedef.cached_result is not None:
+        _, cache_key, exc_info = fixturedef.cached_result
+        fixturedef.cached_result = (_instances.gr_twisted, cache_key, exc_info)
+
+    return True
+
+
+class _ReactorImportHook(object):
+    """Install the lazily chosen reactor when the reactor is imported.
+
+    Importing ``twisted.internet.reactor`` otherwise installs Twisted's
+    default reactor, for example from a test module during collection.
+    """
+
+    name = "twisted.internet.reactor"
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname != self.name:
+            return None
+
+        import importlib.util
+
+        self.uninstall()
+        _ensure_reactor()
+
+        return importlib.util.spec_from_loader(fullname, self)
+
+    def create_module(self, spec):
+        return sys.modules[self.name]
+
+    def exec_module(self, module):
+        pass
+
+    def find_module(self, fullname, path=None):
+        if fullname != self.name:
+            return None
+
+        return self
+
+    def load_module(self, fullname):
+        self.uninstall()
+        _ensure_reactor()
+
+        return sys.modules[fullname]
+
+
+def _install_reactor(reactor_installer, reactor_type):
     """Install the specified reactor and create the greenlet."""
     try:
         reactor_installer()
@@ -445,7 +2588,15 @@ def _install_reactor(reactor_installer, reactor_type):
     import twisted.internet.reactor
 
     _instances.reactor = twisted.internet.reactor
-    init_twisted_greenlet()
+    if _config.slow_callback or _config.monitor_callbacks:
+        _install_callback_monitor()
+    if _config.log_events:
+        _install_log_events()
+
+    if _config.mode == "thread":
+        init_twisted_thread()
+    else:
+        init_twisted_greenlet()
 
 
 def pytest_addoption(parser):
@@ -456,6 +2607,164 @@ def pytest_addoption(parser):
         default="default",
         choices=tuple(reactor_installers.keys()),
     )
+    group.addoption(
+        "--twisted-mode",
+        default="greenlet",
+        choices=("greenlet", "thread"),
+        help=(
+            "run the reactor in a greenlet switched to while waiting, or in"
+            " a thread with tests on the main thread (default: greenlet)"
+        ),
+    )
+    group.addoption(
+        "--twisted-concurrency",
+        type=int,
+        default=1,
+        metavar="N",
+        help=(
+            "start up to N independent async tests at the same time on the"
+            " reactor (default: 1, run one at a time)"
+        ),
+    )
+    group.addoption(
+        "--twisted-hypothesis-concurrency",
+        type=int,
+        default=1,
+        metavar="N",
+        help=(
+            "run up to N Hypothesis examples of a test at the same time,"
+            " rerunning them one at a time to shrink a failure (default: 1)"
+        ),
+    )
+    group.addoption(
+        "--twisted-fixture-setup",
+        default="serial",
+        choices=("serial", "concurrent"),
+        help=(
+            "with 'concurrent', async fixtures of a test are started together"
+            " and only waited for once all of them have been started"
+        ),
+    )
+    group.addoption(
+        "--twisted-sync-fast-path",
+        action="store_true",
+        default=False,
+        help=(
+            "call plain synchronous tests and Hypothesis examples directly"
+            " instead of in the reactor greenlet, only blocking when they"
+            " return a Deferred"
+        ),
+    )
+    group.addoption(
+        "--twisted-deadlock-timeout",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help=(
+            "fail a blocking wait once the reactor has had no delayed calls,"
+            " I/O or thread work for SECONDS (default: 0, never)"
+        ),
+    )
+    group.addoption(
+        "--twisted-durations",
+        type=int,
+        default=None,
+        metavar="N",
+        help=(
+            "show the N slowest async fixture setup, call and teardown"
+            " phases with their reactor time and greenlet switches"
+            " (N=0 for all)"
+        ),
+    )
+    group.addoption(
+        "--twisted-slow-callback",
+        type=float,
+        default=None,
+        metavar="MS",
+        help=(
+            "report reactor callbacks which block the reactor for at least"
+            " MS milliseconds along with the running test"
+        ),
+    )
+    group.addoption(
+        "--twisted-profile",
+        default=None,
+        metavar="DIR",
+        help=(
+            "profile the code run while the reactor greenlet is active and"
+            " write a pstats file per test and a combined one to DIR"
+        ),
+    )
+    group.addoption(
+        "--twisted-trace",
+        default=None,
+        metavar="PATH",
+        help=(
+            "write a Chrome trace of collection, async fixture, test and"
+            " reactor greenlet spans to PATH for chrome://tracing, Perfetto"
+            " or speedscope"
+        ),
+    )
+    group.addoption(
+        "--twisted-log-events",
+        type=int,
+        default=0,
+        metavar="N",
+        help=(
+            "keep the last N twisted.logger events of each test and show"
+            " them with its failure (default: 0, off)"
+        ),
+    )
+    group.addoption(
+        "--twisted-failures",
+        default="full",
+        choices=("full", "clean", "clean-after-report"),
+        help=(
+            "'full' keeps the frames of failed Deferreds for better"
+            " tracebacks, 'clean' drops them as older Twisted versions do and"
+            " 'clean-after-report' drops them once the test was reported"
+            " (default: full)"
+        ),
+    )
+    group.addoption(
+        "--twisted-memtrace",
+        type=int,
+        default=None,
+        metavar="N",
+        help=(
+            "trace allocations with tracemalloc and show the N tests whose"
+            " async fixture setup, call and teardown left the most memory"
+            " allocated (N=0 for all)"
+        ),
+    )
+    group.addoption(
+        "--twisted-dirty-reactor",
+        default=None,
+        choices=("report", "fail"),
+        help=(
+            "after each test's teardown check for delayed calls, readers,"
+            " writers and thread pool jobs it added to the reactor and list"
+            " them at the end or fail the test's teardown"
+        ),
+    )
+    group.addoption(
+        "--twisted-lazy-reactor",
+        action="store_true",
+        default=False,
+        help=(
+            "install the reactor when first needed by a test, fixture or"
+            " blockon() instead of at startup, implies"
+            " --twisted-sync-fast-path"
+        ),
+    )
+    parser.addini(
+        "twisted_timeout",
+        help=(
+            "default seconds after which a test's Deferred is cancelled"
+            " (default: no timeout)"
+        ),
+        default="",
+    )
 
 
 def pytest_configure(config):
@@ -469,12 +2778,98 @@ def pytest_configure(config):
         recommended='pytest_twisted.blockon',
     )(blockon)
 
-    reactor_installers[config.getoption("reactor")]()
+    _concurrency.limit = max(1, config.getoption("twisted_concurrency"))
+    _concurrency.hypothesis_limit = max(
+        1,
+        config.getoption("twisted_hypothesis_concurrency"),
+    )
+    _config.concurrent_fixture_setup = (
+        config.getoption("twisted_fixture_setup") == "concurrent"
+    )
+    _config.mode = config.getoption("twisted_mode")
+    _config.sync_fast_path = (
+        config.getoption("twisted_sync_fast_path") or _config.mode == "thread"
+    )
+    _config.timeout = float(config.getini("twisted_timeout") or 0) or None
+    _config.deadlock_timeout = (
+        config.getoption("twisted_deadlock_timeout") or None
+    )
+    _config.slow_callback = config.getoption("twisted_slow_callback")
+    _config.log_events = max(0, config.getoption("twisted_log_events"))
+    _config.failures = config.getoption("twisted_failures")
+    if _config.failures != "full" and _config.mode != "greenlet":
+        raise pytest.UsageError(
+            "--twisted-failures={} requires --twisted-mode=greenlet".format(
+                _config.failures,
+            ),
+        )
+    _config.dirty_reactor = config.getoption("twisted_dirty_reactor")
+    if _config.dirty_reactor is not None:
+        _instances.reactor_check = _DirtyReactorCheck()
+    config.addinivalue_line(
+        "markers",
+        "twisted_timeout(seconds): cancel the test's Deferred after seconds",
+    )
+    config.addinivalue_line(
+        "markers",
+        "twisted_max_blocking(ms): fail if a reactor callback blocks for"
+        " longer than ms milliseconds",
+    )
+
+    if config.getoption("twisted_durations") is not None:
+        _observers.durations = _DurationsRecorder()
+        _add_phase_observer(_observers.durations)
+        _add_switch_listener(_observers.durations.switch)
+
+    profile_directory = config.getoption("twisted_profile")
+    if profile_directory is not None:
+        if _config.mode != "greenlet":
+            raise pytest.UsageError(
+                "--twisted-profile requires --twisted-mode=greenlet",
+            )
+        _observers.profiler = _ReactorProfiler(
+            directory=os.path.abspath(profile_directory),
+        )
+        _add_switch_listener(_observers.profiler.switch)
+
+    if config.getoption("twisted_memtrace") is not None:
+        try:
+            _observers.memory = _MemoryTracer()
+        except ImportError:
+            raise pytest.UsageError("--twisted-memtrace requires tracemalloc")
+        _add_phase_observer(_observers.memory)
+
+    trace_path = config.getoption("twisted_trace")
+    if trace_path is not None:
+        _observers.trace = _TraceRecorder(path=os.path.abspath(trace_path))
+        _add_phase_observer(_observers.trace)
+        _add_switch_listener(_observers.trace.switch)
+
+    if config.getoption("twisted_lazy_reactor"):
+        _config.lazy_reactor = config.getoption("reactor")
+        _config.sync_fast_path = True
+        if _ReactorImportHook.name not in sys.modules:
+            _instances.reactor_import_hook = _ReactorImportHook()
+            _instances.reactor_import_hook.install()
+            return
+
+        try:
+            _ensure_reactor()
+        except WrongReactorAlreadyInstalledError as e:
+            raise pytest.UsageError(
+                "--twisted-lazy-reactor: twisted.internet.reactor was"
+                " imported before pytest-twisted was configured, {}".format(e),
+            )
+    elif not config.getoption("help", False):
+        reactor_installers[config.getoption("reactor")]()
 
 
 def pytest_unconfigure(config):
-    """Stop the reactor greenlet."""
+    """Stop the reactor greenlet or thread."""
+    if _instances.reactor_import_hook is not None:
+        _instances.reactor_import_hook.uninstall()
     stop_twisted_greenlet()
+    stop_twisted_thread()
 
 
 def _use_asyncio_selector_if_required(config):
@@ -6,15 +6,18 @@ def _async_pytest_fixture_setup(fixturedef, request, mark):
     """Setup an async or async yield fixture."""
     from pytest_twisted import (
         UnrecognizedCoroutineMarkError,
+        _PendingFixtureValue,
         _create_async_yield_fixture_finalizer,
     )
 
     fixture_function = fixturedef.func
 
-    kwargs = {
-        name: request.getfixturevalue(name)
-        for name in fixturedef.argnames
-    }
+    kwargs = {}
+    for name in fixturedef.argnames:
+        value = request.getfixturevalue(name)
+        if isinstance(value, _PendingFixtureValue):
+            value = yield value.wait()
+        kwargs[name] = value
 
     if mark == 'async_fixture':
         arg_value = yield defer.ensureDeferred(
@@ -24,7 +27,10 @@ def _async_pytest_fixture_setup(fixturedef, request, mark):
         coroutine = fixture_function(**kwargs)
 
         request.addfinalizer(
-            _create_async_yield_fixture_finalizer(coroutine=coroutine),
+            _create_async_yield_fixture_finalizer(
+                coroutine=coroutine,
+                request=request,
+            ),
         )
 
         arg_value = yield defer.ensureDeferred(coroutine.__anext__())
@@ -37,24 +43,16 @@ def _async_pytest_fixture_setup(fixturedef, request, mark):
 
 
 @defer.inlineCallbacks
-def _async_pytest_pyfunc_call(pyfuncitem, f, kwargs):
-    """Run test function."""
-    from pytest_twisted import _get_mark
-
-    fixture_kwargs = {
-        name: value
-        for name, value in pyfuncitem.funcargs.items()
-        if name in pyfuncitem._fixtureinfo.argnames
-    }
-    kwargs.update(fixture_kwargs)
-
-    maybe_mark = _get_mark(f)
-    if maybe_mark == 'async_test':
-        result = yield defer.ensureDeferred(f(**kwargs))
-    elif maybe_mark == 'inline_callbacks_test':
-        result = yield f(**kwargs)
-    else:
-        # TODO: maybe deprecate this
-        result = yield f(**kwargs)
-
-    return result
+def _tear_it_down(deferred):
+    """Tear down a specific async yield fixture."""
+    from pytest_twisted import AsyncGeneratorFixtureDidNotStopError
+
+    try:
+        yield deferred
+    except StopAsyncIteration:
+        return
+
+    # TODO: six.raise_from()
+    raise AsyncGeneratorFixtureDidNotStopError.from_generator(
+        generator=deferred,
+    )
@@ -1,4 +1,6 @@
+import json
 import os
+import pstats
 import re
 import sys
 import textwrap
@@ -328,6 +330,32 @@ def test_twisted_greenlet(testdir, cmd_opts):
     assert_outcomes(rr, {"passed": 1})
 
 
+def test_sync_fast_path(testdir, cmd_opts):
+    test_file = """
+    import greenlet
+    from twisted.internet import reactor, defer
+
+    def test_not_in_twisted_greenlet(twisted_greenlet):
+        assert greenlet.getcurrent() is not twisted_greenlet
+
+    def test_succeed_later():
+        d = defer.Deferred()
+        reactor.callLater(0.01, d.callback, 1)
+        return d
+
+    def test_fail_later():
+        d = defer.Deferred()
+        reactor.callLater(0.01, d.errback, RuntimeError("foo"))
+        return d
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-sync-fast-path",),
+        timeout=timeout
+    )
+    assert_outcomes(rr, {"passed": 2, "failed": 1})
+
+
 def test_blockon_in_fixture(testdir, cmd_opts):
     test_file = """
     from twisted.internet import reactor, defer
@@ -379,6 +407,71 @@ def test_blockon_in_fixture_async(testdir, cmd_opts):
     assert_outcomes(rr, {"passed": 2, "failed": 1})
 
 
+def test_blockon_many(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import reactor, defer, task
+    import pytest
+    import pytest_twisted
+
+    running = []
+    peak = []
+
+    def operation(i):
+        running.append(i)
+        peak.append(len(running))
+
+        def finish():
+            running.remove(i)
+            return i * 2
+
+        return task.deferLater(reactor, 0.01 * (i % 3), finish)
+
+    @pytest.fixture
+    def records():
+        return pytest_twisted.blockon_many(
+            (operation(i) for i in range(50)),
+            concurrency=4,
+        )
+
+    def test_results(records):
+        assert records == [i * 2 for i in range(50)]
+        assert max(peak) == 4
+
+    @pytest.fixture
+    def pulled():
+        pulled = []
+
+        def operations():
+            for i in range(10):
+                pulled.append(i)
+                if i == 2:
+                    yield defer.fail(ValueError(i))
+                else:
+                    yield task.deferLater(reactor, 0.01, lambda: None)
+
+        with pytest.raises(ValueError):
+            pytest_twisted.blockon_many(operations(), concurrency=2)
+        return pulled
+
+    def test_failure_stops_pulling(pulled):
+        assert pulled == [0, 1, 2]
+
+    @pytest.fixture
+    def values():
+        return pytest_twisted.blockon_many([1, defer.succeed(2)])
+
+    def test_values(values):
+        assert values == [1, 2]
+
+    def test_invalid_concurrency():
+        with pytest.raises(ValueError):
+            pytest_twisted.blockon_many([], concurrency=0)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(*cmd_opts, timeout=timeout)
+    assert_outcomes(rr, {"passed": 4})
+
+
 @skip_if_no_async_await()
 def test_async_fixture(testdir, cmd_opts):
     pytest_ini_file = """
@@ -1055,6 +1148,44 @@ def test_async_fixture_module_scope(testdir, cmd_opts):
     assert_outcomes(rr, {"passed": 2})
 
 
+@skip_if_no_async_generators()
+@pytest.mark.parametrize(
+    argnames="scope, instances",
+    argvalues=[("class", 2), ("package", 1), ("session", 1)],
+)
+def test_async_yield_fixture_wider_scopes(testdir, cmd_opts, scope, instances):
+    conftest_file = """
+    import pytest
+    import pytest_twisted
+
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_configure(config):
+        pytest_twisted._use_asyncio_selector_if_required(config=config)
+
+    @pytest_twisted.async_yield_fixture(scope={scope!r})
+    async def foo():
+        print("async fixture setup")
+        yield 42
+        print("async fixture teardown")
+    """.format(scope=scope)
+    testdir.makeconftest(conftest_file)
+    test_file = """
+    class TestClass:
+        def test_first(self, foo):
+            assert foo == 42
+
+        def test_second(self, foo):
+            assert foo == 42
+    """
+    testdir.makepyfile(test_one=test_file, test_two=test_file)
+    rr = testdir.run(*cmd_opts + ("-s",), timeout=timeout)
+    assert_outcomes(rr, {"passed": 4})
+    output = rr.stdout.str()
+    assert output.count("async fixture setup") == instances
+    assert output.count("async fixture teardown") == instances
+
+
 def test_inlinecallbacks_method_with_fixture_gets_self(testdir, cmd_opts):
     test_file = """
     import pytest
@@ -1347,3 +1478,1008 @@ def test_hypothesis_inline_callbacks_fails(testdir, cmd_opts):
     testdir.makepyfile(test_file)
     rr = testdir.run(*cmd_opts, timeout=3 * timeout)
     assert_outcomes(rr, {"failed": 1})
+
+
+@skip_if_no_async_await()
+@pytest.mark.parametrize(
+    argnames="concurrency, outcomes",
+    argvalues=[
+        (1, {"passed": 1, "failed": 1}),
+        (2, {"passed": 2}),
+    ],
+)
+def test_concurrency_starts_tests_together(
+        testdir,
+        cmd_opts,
+        concurrency,
+        outcomes,
+):
+    test_file = """
+    from twisted.internet import reactor, defer
+    import pytest
+    import pytest_twisted
+
+    second_started = defer.Deferred()
+
+    @pytest.fixture(scope="module")
+    def shared():
+        return 42
+
+    @pytest_twisted.ensureDeferred
+    async def test_first(shared):
+        await second_started.addTimeout(1, reactor)
+
+    @pytest_twisted.ensureDeferred
+    async def test_second(shared):
+        second_started.callback(None)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-concurrency={}".format(concurrency),),
+        timeout=timeout
+    )
+    assert_outcomes(rr, outcomes)
+
+
+@skip_if_no_async_await()
+def test_concurrency_skips_function_scoped_fixtures(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import reactor, defer
+    import pytest
+    import pytest_twisted
+
+    events = []
+
+    @pytest.fixture
+    def per_test():
+        return 37
+
+    @pytest_twisted.ensureDeferred
+    async def test_first():
+        events.append("first start")
+        d = defer.Deferred()
+        reactor.callLater(0.1, d.callback, None)
+        await d
+        events.append("first end")
+
+    @pytest_twisted.ensureDeferred
+    async def test_second(per_test):
+        events.append("second")
+
+    def test_order():
+        assert events == ["first start", "first end", "second"]
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-concurrency=4",),
+        timeout=timeout
+    )
+    assert_outcomes(rr, {"passed": 3})
+
+
+@skip_if_no_async_await()
+def test_concurrency_respects_setup_hooks(testdir, cmd_opts):
+    conftest_file = """
+    import pytest
+
+    def pytest_configure(config):
+        config.addinivalue_line("markers", "needs_db: needs a database")
+
+    def pytest_runtest_setup(item):
+        if item.get_closest_marker("needs_db") is not None:
+            pytest.skip("no database")
+    """
+    testdir.makeconftest(conftest_file)
+    test_file = """
+    from twisted.internet import reactor, task
+    import pytest
+    import pytest_twisted
+
+    events = []
+
+    @pytest_twisted.ensureDeferred
+    async def test_first():
+        await task.deferLater(reactor, 0.1, lambda: None)
+
+    @pytest.mark.needs_db
+    @pytest_twisted.ensureDeferred
+    async def test_database():
+        events.append("database")
+        raise RuntimeError("no database")
+
+    def test_order():
+        assert events == []
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-concurrency=4",),
+        timeout=timeout
+    )
+    assert_outcomes(rr, {"passed": 2, "skipped": 1})
+
+
+@skip_if_no_async_generators()
+@pytest.mark.parametrize(
+    argnames="setup, outcomes",
+    argvalues=[
+        ("serial", {"errors": 1}),
+        ("concurrent", {"passed": 1}),
+    ],
+)
+def test_fixture_setup_concurrent(testdir, cmd_opts, setup, outcomes):
+    test_file = """
+    from twisted.internet import reactor, defer
+    import pytest
+    import pytest_twisted
+
+    second_started = defer.Deferred()
+
+    @pytest_twisted.async_fixture()
+    async def first():
+        await second_started.addTimeout(1, reactor)
+        return 1
+
+    @pytest_twisted.async_yield_fixture()
+    async def second():
+        second_started.callback(None)
+        yield 2
+
+    @pytest_twisted.async_fixture()
+    async def both(first, second):
+        return first + second
+
+    @pytest.fixture
+    def doubled(both):
+        return 2 * both
+
+    def test_values(first, second, both, doubled):
+        assert (first, second, both, doubled) == (1, 2, 3, 6)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-fixture-setup={}".format(setup),),
+        timeout=timeout
+    )
+    assert_outcomes(rr, outcomes)
+
+
+@skip_if_no_async_await()
+def test_fixture_setup_concurrent_getfixturevalue(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import reactor, task
+    import pytest
+    import pytest_twisted
+
+    @pytest_twisted.async_fixture()
+    async def a():
+        await task.deferLater(reactor, 0.01, lambda: None)
+        return 1
+
+    @pytest_twisted.async_fixture()
+    async def b():
+        await task.deferLater(reactor, 0.01, lambda: None)
+        return 2
+
+    @pytest.fixture
+    def dynamic(request):
+        return request.getfixturevalue("a") + 10
+
+    @pytest.fixture
+    def cached(b, request):
+        return request.getfixturevalue("a") + 20
+
+    def test_dynamic(request):
+        assert request.getfixturevalue("a") == 1
+
+    def test_in_fixture(dynamic):
+        assert dynamic == 11
+
+    def test_cached(a, cached):
+        assert (a, cached) == (1, 21)
+    """
+    testdir.makepyfile(test_file)
+    # waiting in the test itself needs it to run outside the reactor greenlet
+    rr = testdir.run(
+        *cmd_opts + (
+            "--twisted-fixture-setup=concurrent",
+            "--twisted-sync-fast-path",
+        ),
+        timeout=timeout
+    )
+    assert_outcomes(rr, {"passed": 3})
+
+
+@skip_if_no_async_await()
+def test_fixture_setup_concurrent_exception(testdir, cmd_opts):
+    test_file = """
+    import pytest_twisted
+
+    class UniqueLocalException(Exception):
+        pass
+
+    @pytest_twisted.async_fixture()
+    async def foo():
+        raise UniqueLocalException("some message")
+
+    def test_first(foo):
+        pass
+
+    def test_second(foo):
+        pass
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-fixture-setup=concurrent",),
+        timeout=timeout
+    )
+    rr.stdout.fnmatch_lines(lines2=["E*.UniqueLocalException: some message*"])
+    assert_outcomes(rr, {"errors": 2})
+
+
+@skip_if_no_async_await()
+def test_virtual_time(testdir, cmd_opts):
+    test_file = """
+    import time
+
+    from twisted.internet import reactor, protocol, task
+    import pytest_twisted
+
+    earlier = []
+
+    def test_schedules_before_virtual_time():
+        earlier.append(reactor.callLater(1000, lambda: None))
+
+    @pytest_twisted.ensureDeferred
+    async def test_skips_ahead(twisted_virtual_time):
+        real_start, start = time.time(), reactor.seconds()
+        await task.deferLater(reactor, 60, lambda: None)
+        assert reactor.seconds() - start >= 60
+        assert time.time() - real_start < 10
+
+    def test_earlier_call_uses_virtual_time():
+        call, = earlier
+        call.reset(100)
+        assert call.getTime() - reactor.seconds() > 99
+        call.cancel()
+
+    @pytest_twisted.ensureDeferred
+    async def test_waits_while_listening(twisted_virtual_time):
+        port = reactor.listenTCP(0, protocol.Factory(), interface="127.0.0.1")
+        real_start = time.time()
+        await task.deferLater(reactor, 0.2, lambda: None)
+        await port.stopListening()
+        assert time.time() - real_start >= 0.2
+
+    @pytest_twisted.ensureDeferred
+    async def test_real_time_without_fixture():
+        real_start = time.time()
+        await task.deferLater(reactor, 0.2, lambda: None)
+        assert time.time() - real_start >= 0.2
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(*cmd_opts, timeout=timeout)
+    assert_outcomes(rr, {"passed": 5})
+
+
+def test_timeout_marker(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import defer
+    import pytest_twisted
+
+    @pytest_twisted.timeout(0.2)
+    @pytest_twisted.inlineCallbacks
+    def test_hangs():
+        yield defer.Deferred()
+
+    @pytest_twisted.inlineCallbacks
+    def test_next():
+        yield defer.succeed(None)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(*cmd_opts, timeout=timeout)
+    rr.stdout.fnmatch_lines(lines2=[
+        "*yield defer.Deferred()*",
+        "*DeferredTimeoutError: test did not complete within 0.2 seconds*",
+    ])
+    assert_outcomes(rr, {"passed": 1, "failed": 1})
+
+
+def test_timeout_ini(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import defer, reactor, task
+    import pytest_twisted
+
+    @pytest_twisted.inlineCallbacks
+    def test_hangs():
+        yield defer.Deferred()
+
+    @pytest_twisted.timeout(0)
+    @pytest_twisted.inlineCallbacks
+    def test_disabled():
+        yield task.deferLater(reactor, 0.4, lambda: None)
+
+    @pytest_twisted.inlineCallbacks
+    def test_ignores_cancellation():
+        d = defer.Deferred(lambda d: None)
+        yield d
+    """
+    testdir.makeini("""
+    [pytest]
+    twisted_timeout = 0.2
+    """)
+    testdir.makepyfile(test_file)
+    rr = testdir.run(*cmd_opts, timeout=timeout)
+    assert_outcomes(rr, {"passed": 1, "failed": 2})
+
+
+def test_deadlock_timeout(testdir, cmd_opts):
+    test_file = """
+    import pytest
+    from twisted.internet import defer, reactor, task
+    import pytest_twisted
+
+    @pytest.fixture
+    def never():
+        return pytest_twisted.blockon(defer.Deferred())
+
+    @pytest_twisted.inlineCallbacks
+    def test_deadlocked():
+        yield defer.Deferred()
+
+    @pytest_twisted.inlineCallbacks
+    def test_delayed_call():
+        yield task.deferLater(reactor, 0.5, lambda: None)
+
+    def test_fixture_deadlocked(never):
+        pass
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-deadlock-timeout=0.2",),
+        timeout=timeout
+    )
+    rr.stdout.fnmatch_lines(lines2=[
+        "*yield defer.Deferred()*",
+        "*ReactorDeadlockError: reactor is idle so <Deferred*",
+    ])
+    assert_outcomes(rr, {"passed": 1, "failed": 1, "errors": 1})
+
+
+@skip_if_no_async_generators()
+def test_durations(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import reactor, task
+    import pytest_twisted
+
+    @pytest_twisted.async_yield_fixture()
+    async def foo():
+        await task.deferLater(reactor, 0.1, lambda: None)
+        yield 42
+        await task.deferLater(reactor, 0.1, lambda: None)
+
+    @pytest_twisted.ensureDeferred
+    async def test_succeed(foo):
+        await task.deferLater(reactor, 0.1, lambda: None)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(*cmd_opts + ("--twisted-durations=0",), timeout=timeout)
+    assert_outcomes(rr, {"passed": 1})
+    rr.stdout.fnmatch_lines(lines2=[
+        "*= twisted phases =*",
+        "*s wall 0.1*s reactor * switches  *test_succeed",
+    ])
+    for name in ("setup foo", "call", "teardown foo"):
+        rr.stdout.fnmatch_lines(lines2=["* switches  {} *".format(name)])
+
+
+def test_slow_callback(testdir, cmd_opts):
+    test_file = """
+    import time
+
+    from twisted.internet import reactor, task
+    import pytest_twisted
+
+    def busy():
+        time.sleep(0.3)
+
+    @pytest_twisted.inlineCallbacks
+    def test_blocks():
+        yield task.deferLater(reactor, 0, busy)
+
+    @pytest_twisted.max_blocking(100)
+    @pytest_twisted.inlineCallbacks
+    def test_limited():
+        yield task.deferLater(reactor, 0, busy)
+
+    @pytest_twisted.max_blocking(ms=100)
+    @pytest_twisted.inlineCallbacks
+    def test_waits():
+        yield task.deferLater(reactor, 0.3, lambda: None)
+
+    def test_delayed_call_unchanged():
+        call = reactor.callLater(60, busy, 1, key=2)
+        try:
+            assert call.func is busy
+            assert (call.args, call.kw) == ((1,), {"key": 2})
+        finally:
+            call.cancel()
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-slow-callback=200",),
+        timeout=timeout
+    )
+    rr.stdout.fnmatch_lines(lines2=[
+        "*ReactorBlockedError: reactor blocked for * ms by * exceeding 100 ms",
+        "*= reactor callbacks over 200 ms =*",
+    ])
+    for name in ("test_blocks", "test_limited"):
+        rr.stdout.fnmatch_lines(
+            lines2=["* ms * test_slow_callback.py::{}".format(name)],
+        )
+    assert_outcomes(rr, {"passed": 3, "failed": 1})
+
+
+@pytest.mark.parametrize(
+    "arguments",
+    ["", "'fast'", "1, 2", "seconds=1"],
+)
+def test_max_blocking_invalid_mark(testdir, cmd_opts, arguments):
+    test_file = """
+    import pytest
+
+    @pytest.mark.twisted_max_blocking({arguments})
+    def test_marked():
+        pass
+    """.format(arguments=arguments)
+    testdir.makepyfile(test_file)
+    rr = testdir.run(*cmd_opts, timeout=timeout)
+    assert "takes a number of milliseconds" in rr.stderr.str()
+
+
+def test_profile(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import reactor, task
+    import pytest_twisted
+
+    def in_reactor():
+        return sum(range(1000))
+
+    @pytest_twisted.inlineCallbacks
+    def test_profiled():
+        yield task.deferLater(reactor, 0, in_reactor)
+
+    def test_sync():
+        pass
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-profile=profiles",),
+        timeout=timeout
+    )
+    assert_outcomes(rr, {"passed": 2})
+    rr.stdout.fnmatch_lines(lines2=["*twisted profiles of 2 tests*"])
+
+    directory = testdir.tmpdir.join("profiles")
+    stats = pstats.Stats(
+        str(directory.join("test_profile.py_test_profiled.prof")),
+    )
+    profiled = [function for _, _, function in stats.stats]
+    assert "in_reactor" in profiled
+    assert "test_sync" not in profiled
+    assert directory.join("combined.prof").check()
+
+
+@skip_if_no_async_await()
+def test_trace(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import reactor, task
+    import pytest_twisted
+
+    @pytest_twisted.async_fixture()
+    async def foo():
+        await task.deferLater(reactor, 0.1, lambda: None)
+
+    @pytest_twisted.async_fixture()
+    async def bar():
+        await task.deferLater(reactor, 0.1, lambda: None)
+
+    @pytest_twisted.ensureDeferred
+    async def test_traced(foo, bar):
+        await task.deferLater(reactor, 0.01, lambda: None)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + (
+            "--twisted-trace=trace.json",
+            "--twisted-fixture-setup=concurrent",
+        ),
+        timeout=timeout
+    )
+    assert_outcomes(rr, {"passed": 1})
+    rr.stdout.fnmatch_lines(lines2=["*twisted trace written to*"])
+
+    with open(str(testdir.tmpdir.join("trace.json"))) as f:
+        events = json.load(f)["traceEvents"]
+    spans = [event for event in events if event["ph"] == "X"]
+    names = {span["name"] for span in spans}
+    assert "collection" in names
+    assert "call test_trace.py::test_traced" in names
+
+    setups = [
+        span
+        for span in spans
+        if span["name"].startswith("run setup ")
+    ]
+    assert len(setups) == 2
+    assert setups[0]["tid"] != setups[1]["tid"]
+
+    lanes = {}
+    for span in sorted(spans, key=lambda span: span["ts"]):
+        ends = lanes.setdefault(span["tid"], [])
+        while ends and ends[-1] <= span["ts"]:
+            ends.pop()
+        assert not ends or span["ts"] + span["dur"] <= ends[-1] + 0.01
+        ends.append(span["ts"] + span["dur"])
+
+
+def test_log_events(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import defer, reactor, task
+    from twisted.logger import Logger
+    import pytest_twisted
+
+    log = Logger()
+
+    def chatter(name):
+        for i in range(1000):
+            log.info("{name} message {i}", name=name, i=i)
+
+    @pytest_twisted.inlineCallbacks
+    def test_passes():
+        yield task.deferLater(reactor, 0, chatter, "passing")
+
+    @pytest_twisted.inlineCallbacks
+    def test_fails():
+        yield task.deferLater(reactor, 0, chatter, "failing")
+        assert False
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-log-events=3", "-rA"),
+        timeout=timeout
+    )
+    assert_outcomes(rr, {"passed": 1, "failed": 1})
+    rr.stdout.fnmatch_lines(lines2=[
+        "*Captured twisted log call*",
+        "*failing message 997",
+        "*failing message 998",
+        "*failing message 999",
+    ])
+    output = rr.stdout.str()
+    assert "failing message 996" not in output
+    assert "passing message" not in output
+
+
+@pytest.mark.parametrize(
+    "failures, outcomes",
+    [
+        ("full", {"passed": 2, "failed": 1}),
+        ("clean", {"passed": 3}),
+        ("clean-after-report", {"passed": 3}),
+    ],
+)
+def test_failures_release_frames(testdir, cmd_opts, failures, outcomes):
+    test_file = """
+    import gc
+    import weakref
+
+    from twisted.internet import defer
+    from twisted.python import failure
+    import pytest_twisted
+
+    class Big(object):
+        payload = None
+
+    references = []
+    deferreds = []
+
+    def fail():
+        big = Big()
+        big.payload = bytearray(10000)
+        references.append(weakref.ref(big))
+        raise ValueError("boom")
+
+    @pytest_twisted.inlineCallbacks
+    def test_fail_many():
+        for _ in range(1000):
+            deferreds.append(defer.maybeDeferred(fail))
+        yield defer.succeed(None)
+
+    def test_frames_released():
+        gc.collect()
+        alive = sum(1 for reference in references if reference() is not None)
+        for d in deferreds:
+            d.addErrback(lambda _: None)
+        assert alive == 0
+
+    def test_plain_failure_kept():
+        try:
+            fail()
+        except ValueError:
+            f = failure.Failure()
+        assert f.tb is not None
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-failures={}".format(failures),),
+        timeout=timeout
+    )
+    assert_outcomes(rr, outcomes)
+
+
+def test_failures_require_greenlet_mode(testdir, cmd_opts):
+    testdir.makepyfile("""
+    def test_succeed():
+        pass
+    """)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-mode=thread", "--twisted-failures=clean"),
+        timeout=timeout
+    )
+    assert "requires --twisted-mode=greenlet" in rr.stderr.str()
+
+
+def test_memtrace(testdir, cmd_opts):
+    test_file = """
+    from twisted.internet import reactor, task
+    import pytest_twisted
+
+    leaked = []
+
+    def leak():
+        leaked.append(bytearray(1024 * 1024))
+
+    @pytest_twisted.inlineCallbacks
+    def test_leaks():
+        yield task.deferLater(reactor, 0, leak)
+
+    @pytest_twisted.inlineCallbacks
+    def test_clean():
+        yield task.deferLater(reactor, 0, lambda: None)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(*cmd_opts + ("--twisted-memtrace=1",), timeout=timeout)
+    assert_outcomes(rr, {"passed": 2})
+    rr.stdout.fnmatch_lines(lines2=[
+        "*1 tests leaving the most twisted memory*",
+        "10??.? KiB test_memtrace.py::test_leaks",
+        "    1024.? KiB *test_memtrace.py:7",
+    ])
+    _, report = rr.stdout.str().split("leaving the most twisted memory")
+    assert "::test_clean" not in report
+
+
+@pytest.mark.parametrize(
+    "mode, outcomes",
+    [("report", {"passed": 3}), ("fail", {"passed": 3, "errors": 1})],
+)
+def test_dirty_reactor(testdir, cmd_opts, request, mode, outcomes):
+    test_file = """
+    import pytest
+    from twisted.internet import reactor, task
+    import pytest_twisted
+
+    def forgotten():
+        pass
+
+    @pytest.fixture(scope="module")
+    def ticking():
+        call = reactor.callLater(60, lambda: None)
+        yield
+        call.cancel()
+
+    @pytest_twisted.inlineCallbacks
+    def test_clean(ticking):
+        yield task.deferLater(reactor, 0, lambda: None)
+
+    def test_leaks():
+        reactor.callLater(60, forgotten)
+
+    def test_cleans_up():
+        reactor.callLater(60, lambda: None).cancel()
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + (
+            "--twisted-dirty-reactor={}".format(mode),
+            # timing callbacks must not hide what was scheduled
+            "--twisted-slow-callback=1000",
+        ),
+        timeout=timeout
+    )
+    assert_outcomes(rr, outcomes)
+    if mode == "report":
+        rr.stdout.fnmatch_lines(lines2=[
+            "*twisted dirty reactor*",
+            "test_dirty_reactor.py::test_leaks",
+            "    delayed call test_dirty_reactor.forgotten due in *s",
+        ])
+    else:
+        rr.stdout.fnmatch_lines(lines2=[
+            "*DirtyReactorError: test left the reactor dirty: delayed call"
+            " test_dirty_reactor.forgotten due in *s",
+        ])
+    assert "::test_clean" not in rr.stdout.str().split("PASSED")[-1]
+
+
+def test_lazy_reactor(testdir, cmd_opts):
+    test_file = """
+    import sys
+
+    import pytest
+    from twisted.internet import defer
+    import pytest_twisted
+
+    def test_plain():
+        assert "twisted.internet.reactor" not in sys.modules
+
+    @pytest_twisted.inlineCallbacks
+    def test_marked(twisted_greenlet):
+        assert "twisted.internet.reactor" in sys.modules
+        assert twisted_greenlet is not None
+        assert twisted_greenlet is pytest_twisted._instances.gr_twisted
+        yield defer.succeed(None)
+
+    def test_returns_deferred():
+        return defer.succeed(None)
+
+    @pytest.fixture
+    def greenlet_user(twisted_greenlet):
+        return twisted_greenlet
+
+    def test_fixture(greenlet_user, twisted_greenlet):
+        assert greenlet_user is not None
+        assert twisted_greenlet is greenlet_user
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(*cmd_opts + ("--twisted-lazy-reactor",), timeout=timeout)
+    assert_outcomes(rr, {"passed": 4})
+
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-lazy-reactor", "-k", "fixture"),
+        timeout=timeout
+    )
+    assert_outcomes(rr, {"passed": 1, "deselected": 3})
+
+
+def test_lazy_reactor_module_import(testdir, cmd_opts, request):
+    skip_if_reactor_not(request, "asyncio")
+
+    test_file = """
+    from twisted.internet import asyncioreactor, defer, reactor
+    import pytest_twisted
+
+    def test_plain():
+        assert isinstance(reactor, asyncioreactor.AsyncioSelectorReactor)
+
+    @pytest_twisted.inlineCallbacks
+    def test_marked():
+        import twisted.internet.reactor
+
+        assert twisted.internet.reactor is reactor
+        yield defer.succeed(None)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(*cmd_opts + ("--twisted-lazy-reactor",), timeout=timeout)
+    assert_outcomes(rr, {"passed": 2})
+
+
+def test_lazy_reactor_imported_before_configure(testdir, cmd_opts, request):
+    skip_if_reactor_not(request, "asyncio")
+    conftest_file = """
+    from twisted.internet import reactor
+    """
+    testdir.makeconftest(conftest_file)
+    test_file = """
+    def test_succeed():
+        pass
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(*cmd_opts + ("--twisted-lazy-reactor",), timeout=timeout)
+    assert "imported before pytest-twisted" in rr.stderr.str()
+
+
+def test_import_is_cheap(testdir):
+    code = textwrap.dedent("""
+    import sys
+
+    import pytest_twisted
+
+    heavy = [
+        name
+        for name in ("decorator", "greenlet", "twisted.internet.defer")
+        if name in sys.modules
+    ]
+    assert not heavy, heavy
+    """)
+    rr = testdir.run(sys.executable, "-c", code, timeout=timeout)
+    assert rr.ret == 0, format_run_result_output_for_assert(rr)
+
+
+@skip_if_no_async_generators()
+def test_thread_mode(testdir, cmd_opts, request):
+    if request.config.getoption("reactor", "default") == "qt5reactor":
+        pytest.skip("Qt must run on the main thread")
+
+    test_file = """
+    import threading
+
+    import pytest
+    from twisted.internet import defer, reactor, task
+    import pytest_twisted
+
+    def in_main_thread():
+        return isinstance(threading.current_thread(), threading._MainThread)
+
+    @pytest_twisted.async_yield_fixture()
+    async def foo():
+        assert not in_main_thread()
+        yield 42
+
+    def test_plain(twisted_greenlet):
+        assert twisted_greenlet is None
+        assert in_main_thread()
+
+    @pytest_twisted.ensureDeferred
+    async def test_async(foo):
+        assert foo == 42
+        assert not in_main_thread()
+        await task.deferLater(reactor, 0.01, lambda: None)
+
+    def test_returns_deferred():
+        return defer.succeed(None)
+
+    def test_blockon():
+        assert pytest_twisted.blockon(defer.succeed(42)) == 42
+        with pytest.raises(ValueError):
+            pytest_twisted.blockon(defer.fail(ValueError()))
+
+    def test_blockon_many():
+        operations = (
+            task.deferLater(reactor, 0.01, in_main_thread) for _ in range(5)
+        )
+        assert pytest_twisted.blockon_many(operations, concurrency=2) == [
+            False,
+        ] * 5
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(*cmd_opts + ("--twisted-mode=thread",), timeout=timeout)
+    assert_outcomes(rr, {"passed": 5})
+
+
+@skip_if_no_async_await()
+@skip_if_hypothesis_unavailable()
+def test_hypothesis_examples_shrink(testdir, cmd_opts):
+    test_file = """
+    import hypothesis
+    from hypothesis import strategies
+    from twisted.internet import reactor, task
+    import pytest_twisted
+
+    @hypothesis.settings(database=None, max_examples=200)
+    @hypothesis.given(x=strategies.integers(min_value=0))
+    @pytest_twisted.ensureDeferred
+    async def test_synchronous(x):
+        assert x < 10
+
+    @hypothesis.settings(database=None, max_examples=5, deadline=None)
+    @hypothesis.given(x=strategies.integers())
+    @pytest_twisted.ensureDeferred
+    async def test_waits(x):
+        assert await task.deferLater(reactor, 0, lambda: x) == x
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-sync-fast-path",),
+        timeout=timeout
+    )
+    rr.stdout.fnmatch_lines(lines2=["*x=10*"])
+    outcomes = rr.parseoutcomes()
+    assert (outcomes.get("passed"), outcomes.get("failed")) == (1, 1)
+
+
+@skip_if_hypothesis_unavailable()
+@pytest.mark.parametrize(
+    argnames="options, in_twisted_greenlet",
+    argvalues=[
+        ((), True),
+        (("--twisted-sync-fast-path",), False),
+    ],
+)
+def test_hypothesis_examples_greenlet(
+        testdir,
+        cmd_opts,
+        options,
+        in_twisted_greenlet,
+):
+    test_file = """
+    import greenlet
+    import hypothesis
+    from hypothesis import strategies
+    from twisted.internet import defer
+    import pytest_twisted
+
+    @hypothesis.settings(database=None, max_examples=5)
+    @hypothesis.given(x=strategies.integers())
+    @pytest_twisted.inlineCallbacks
+    def test_greenlet(twisted_greenlet, x):
+        current = greenlet.getcurrent()
+        assert (current is twisted_greenlet) is {in_twisted_greenlet}
+        yield defer.succeed(x)
+    """.format(in_twisted_greenlet=in_twisted_greenlet)
+    testdir.makepyfile(test_file)
+    rr = testdir.run(*cmd_opts + options, timeout=timeout)
+    assert_outcomes(rr, {"passed": 1})
+
+
+@skip_if_no_async_await()
+@skip_if_hypothesis_unavailable()
+def test_hypothesis_concurrency(testdir, cmd_opts):
+    test_file = """
+    import time
+
+    import hypothesis
+    from hypothesis import strategies
+    from twisted.internet import reactor, task
+    import pytest_twisted
+
+    @hypothesis.settings(database=None, max_examples=20)
+    @hypothesis.given(x=strategies.integers())
+    @pytest_twisted.ensureDeferred
+    async def test_waits(x):
+        await task.deferLater(reactor, 0.2, lambda: None)
+
+    @hypothesis.settings(database=None, max_examples=200)
+    @hypothesis.given(x=strategies.integers(min_value=0))
+    @pytest_twisted.ensureDeferred
+    async def test_fails(x):
+        await task.deferLater(reactor, 0, lambda: None)
+        assert x < 10
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-hypothesis-concurrency=10", "--durations=0"),
+        timeout=timeout
+    )
+    rr.stdout.fnmatch_lines(lines2=["*x=10*"])
+    outcomes = rr.parseoutcomes()
+    assert (outcomes.get("passed"), outcomes.get("failed")) == (1, 1)
+    durations = re.search(r"([\d.]+)s call .*::test_waits", rr.stdout.str())
+    assert float(durations.group(1)) < 20 * 0.2
+
+
+@skip_if_no_async_await()
+@skip_if_hypothesis_unavailable()
+def test_hypothesis_concurrency_draw_after_wait(testdir, cmd_opts):
+    test_file = """
+    import hypothesis
+    from hypothesis import strategies
+    from twisted.internet import reactor, task
+    import pytest_twisted
+
+    @hypothesis.settings(database=None, max_examples=20)
+    @hypothesis.given(data=strategies.data())
+    @pytest_twisted.ensureDeferred
+    async def test_draws(data):
+        await task.deferLater(reactor, 0, lambda: None)
+        x = data.draw(strategies.integers())
+        hypothesis.note("drew {}".format(x))
+        assert isinstance(x, int)
+    """
+    testdir.makepyfile(test_file)
+    rr = testdir.run(
+        *cmd_opts + ("--twisted-hypothesis-concurrency=4",),
+        timeout=timeout
+    )
+    assert_outcomes(rr, {"passed": 1})